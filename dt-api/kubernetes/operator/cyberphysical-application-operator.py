@@ -1,8 +1,18 @@
-import kopf, requests, json, random, datetime, os
+import kopf, requests, json, random, datetime, os, copy, time
+import asyncio, functools, concurrent.futures, aiohttp
 from kubernetes import client
-from kubernetes.utils import create_from_dict
-from k8s_utils import delete_from_dict
+from k8s_utils import (
+    AsyncApi,
+    shared_api_client,
+    FailToCreateError,
+    FailToDeleteError,
+    create_from_dicts,
+    delete_from_dicts,
+    wait_for_pods_ready,
+    wait_for_pods_deleted,
+)
 from graph_utils import generate_chart
+from placement_utils import default_engine
 
 CLUSTER_IP = os.environ.get("CLUSTER_IP")
 
@@ -11,10 +21,66 @@ if not CLUSTER_IP:
     exit(1)
 
 
+# migrations running at the same time, across all the CPAs
+max_concurrent_migrations = int(os.environ.get("MAX_CONCURRENT_MIGRATIONS", 10))
+migration_semaphore = asyncio.Semaphore(max_concurrent_migrations)
+# a CPA is migrated by one handler at a time
+migration_locks = {}
+# autonomous migrations, ODTE of the twins read from Prometheus if set, else from /metrics
+auto_migration_interval = float(os.environ.get("AUTO_MIGRATION_INTERVAL", 30))
+prometheus_url = os.environ.get("PROMETHEUS_URL")
+# per CPA: violations of the requirement, end of the last migration
+auto_migration_state = {}
+# scores the target zones of the migrations, refreshed in the background
+placement_engine = default_engine(
+    refresh_interval=float(os.environ.get("PLACEMENT_REFRESH_INTERVAL", 30))
+)
+# create the twin objects with server-side apply instead of create
+server_side_apply = os.environ.get("SERVER_SIDE_APPLY", "false").lower() == "true"
+http_session = None
+# "stream": the target pulls the dump from the source, "operator": relayed by the operator
+state_transfer = os.environ.get("STATE_TRANSFER", "stream")
+state_transfer_compression = (
+    os.environ.get("STATE_TRANSFER_COMPRESSION", "false").lower() == "true"
+)
+# with "stream", copy the state while the source still ingests (pre-copy rounds)
+state_transfer_precopy = (
+    os.environ.get("STATE_TRANSFER_PRECOPY", "false").lower() == "true"
+)
+
+
+@kopf.on.startup()
+async def startup_fn(logger, **kwargs):
+    global http_session
+    # blocking Kubernetes calls of the migrations run in the default executor
+    asyncio.get_running_loop().set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_migrations * 2)
+    )
+    placement_engine.start(logger)
+    http_session = aiohttp.ClientSession()
+
+
+@kopf.on.cleanup()
+async def cleanup_fn(**kwargs):
+    placement_engine.stop()
+    await http_session.close()
+
+
+def limit_concurrency(handler):
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        key = f"{kwargs.get('namespace')}/{kwargs.get('name')}"
+        lock = migration_locks.setdefault(key, asyncio.Lock())
+        async with lock, migration_semaphore:
+            return await handler(*args, **kwargs)
+
+    return wrapper
+
+
 @kopf.on.create("cyberphysicalapplications")
-def create_fn(spec, name, namespace, meta, logger, **kwargs):
-    k8s_client = client.ApiClient()
-    k8s_custom_object = client.CustomObjectsApi()
+async def create_fn(spec, name, namespace, meta, logger, **kwargs):
+    k8s_client = shared_api_client()
+    k8s_custom_object = AsyncApi(client.CustomObjectsApi())
 
     deployments = spec.get("deployments")
     preferred_affinity = spec.get("requirements").get("preferredAffinity")
@@ -41,6 +107,9 @@ def create_fn(spec, name, namespace, meta, logger, **kwargs):
             config["spec"]["template"]["spec"].update(
                 {"nodeSelector": {"zone": f"{deployment_affinity}"}}
             )
+            set_container_env(
+                config, odte_env(spec.get("requirements")) + twin_env(namespace, name)
+            )
             deployment_namespace = config.get("metadata").get("namespace")
             deployment_app_name = config.get("metadata").get("labels").get("app")
             deployment_prometheus_url = (
@@ -56,10 +125,28 @@ def create_fn(spec, name, namespace, meta, logger, **kwargs):
 
         kopf.label(config, {"related-to": f"{name}"})
         kopf.adopt(config)
-        try:
-            create_from_dict(k8s_client, config)
-        except Exception as e:
-            logger.exception("Exception in object creation.")
+
+    try:
+        await create_from_dicts(
+            k8s_client, deployment_configs, server_side_apply=server_side_apply
+        )
+    except FailToCreateError:
+        logger.exception("Exception in object creation.")
+
+    # warm pool, an idle twin on every other candidate affinity
+    if spec.get("warmPool"):
+        await create_standby_instances(
+            k8s_client,
+            spec,
+            name,
+            namespace,
+            [
+                deployment.get("affinity")
+                for deployment in deployments
+                if deployment.get("affinity") != deployment_affinity
+            ],
+            logger,
+        )
 
     annotations_patch = {"metadata": {"annotations": dict(meta.annotations)}}
     annotations_patch["metadata"]["annotations"][
@@ -78,7 +165,7 @@ def create_fn(spec, name, namespace, meta, logger, **kwargs):
     group = "test.dev"
     version = "v1"
     plural = "cyberphysicalapplications"
-    resp = k8s_custom_object.patch_namespaced_custom_object(
+    resp = await k8s_custom_object.patch_namespaced_custom_object(
         group, version, namespace, plural, name, body=annotations_patch
     )
 
@@ -102,55 +189,280 @@ def get_prometheus_odte(prometheus_url, twin_of, logger):
         raise Exception
 
 
+def odte_env(requirements):
+    # ODTE parameters of the twin, taken from spec.requirements
+    env = []
+    if requirements is None:
+        return env
+
+    if requirements.get("odte") is not None:
+        env.append({"name": "ODTE_THRESHOLD", "value": str(requirements.get("odte"))})
+
+    parameters = requirements.get("odteParameters") or {}
+    parameters_env = {
+        "windowLength": "ODTE_WINDOW_LENGTH",
+        "desiredTimeliness": "ODTE_DESIRED_TIMELINESS",
+        "expectedMsgRate": "ODTE_EXPECTED_MSG_RATE",
+    }
+    for field, env_name in parameters_env.items():
+        if parameters.get(field) is not None:
+            env.append({"name": env_name, "value": str(parameters.get(field))})
+
+    if parameters.get("windows"):
+        env.append(
+            {
+                "name": "ODTE_WINDOWS",
+                "value": ",".join(str(window) for window in parameters.get("windows")),
+            }
+        )
+
+    return env
+
+
+def twin_env(namespace, name):
+    # identity of the twin, shared by its instances and distinct across the CPAs
+    return [{"name": "MQTT_CLIENT_ID", "value": f"dt-{namespace}-{name}"}]
+
+
+def set_container_env(config, env):
+    container = config["spec"]["template"]["spec"]["containers"][0]
+    names = [var.get("name") for var in env]
+    container["env"] = [
+        var for var in container.get("env", []) if var.get("name") not in names
+    ] + env
+
+
+def standby_configs(deployment, spec, name, namespace):
+    # copies of the configs of an affinity, for an idle instance of the warm pool
+    affinity = deployment.get("affinity")
+    configs = copy.deepcopy(deployment.get("configs"))
+    for config in configs:
+        if config.get("kind") == "Deployment":
+            config["spec"]["template"]["spec"].update(
+                {"nodeSelector": {"zone": f"{affinity}"}}
+            )
+            app_name = config.get("metadata").get("labels").get("app")
+            set_container_env(
+                config,
+                odte_env(spec.get("requirements"))
+                + twin_env(namespace, name)
+                + [
+                    {
+                        "name": "STANDBY",
+                        "valueFrom": {
+                            "configMapKeyRef": {
+                                "name": f"{app_name}-standby",
+                                "key": "standby",
+                            }
+                        },
+                    }
+                ],
+            )
+
+        kopf.label(config, {"related-to": f"{name}"})
+        kopf.adopt(config)
+
+    return configs
+
+
+def standby_flag(app_name, namespace, name, standby):
+    # read by the twin when its container starts: once bound, a restarted twin
+    # does not come back idle, and unlike the pod template changing it does
+    # not roll the deployment out
+    config = {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {"name": f"{app_name}-standby", "namespace": namespace},
+        "data": {"standby": "true" if standby else "false"},
+    }
+    kopf.label(config, {"related-to": f"{name}"})
+    kopf.adopt(config)
+    return config
+
+
+def migrated_flag(app_name, namespace, name, migrated):
+    # read by the target twin when its container starts: it waits for the state
+    # until the restore, a restart after it connects the twin
+    config = {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {"name": f"{app_name}-migrated", "namespace": namespace},
+        "data": {"migrated": "true" if migrated else "false"},
+    }
+    kopf.label(config, {"related-to": f"{name}"})
+    kopf.adopt(config)
+    return config
+
+
+async def set_standby_flags(k8s_client, flags, logger):
+    # applied, a flag is left behind by the previous standby of the deployment
+    try:
+        await create_from_dicts(k8s_client, flags, server_side_apply=True)
+    except FailToCreateError:
+        logger.exception("Exception setting standby flags.")
+
+
+async def set_migrated_flag(
+    k8s_client, app_name, namespace, name, migrated, logger
+):
+    # applied, a flag is left behind by the previous target of the deployment
+    try:
+        await create_from_dicts(
+            k8s_client,
+            [migrated_flag(app_name, namespace, name, migrated)],
+            server_side_apply=True,
+        )
+    except FailToCreateError:
+        logger.exception("Exception setting the migrated flag.")
+
+
+async def create_standby_instances(
+    k8s_client, spec, name, namespace, affinities, logger
+):
+    configs = []
+    for deployment in spec.get("deployments"):
+        if deployment.get("affinity") in affinities:
+            configs += standby_configs(deployment, spec, name, namespace)
+
+    await set_standby_flags(
+        k8s_client,
+        [
+            standby_flag(
+                config.get("metadata").get("labels").get("app"),
+                config.get("metadata").get("namespace"),
+                name,
+                True,
+            )
+            for config in configs
+            if config.get("kind") == "Deployment"
+        ],
+        logger,
+    )
+
+    try:
+        await create_from_dicts(k8s_client, configs, server_side_apply=server_side_apply)
+    except FailToCreateError:
+        logger.exception("Exception creating standby instances.")
+
+
+async def abort_migration(k8s_client, source_port, target_configs, standby, logger):
+    # the source stopped ingesting for the dump, hand the twin back to it
+    url = f"http://{CLUSTER_IP}:{source_port}/resume"
+    try:
+        async with http_session.post(url) as resp:
+            print(await resp.text())
+    except aiohttp.ClientError:
+        logger.exception("Exception resuming the source instance.")
+
+    # a standby target stays idle, its state is replaced on the next bind
+    if not standby:
+        try:
+            await delete_from_dicts(k8s_client, target_configs)
+        except FailToDeleteError:
+            logger.exception("Exception deleting the target objects.")
+    logger.error("Migration aborted, the source instance keeps the twin.")
+
+
+async def standby_running(k8s_core_v1, app_name, namespace):
+    resp = await k8s_core_v1.list_namespaced_pod(
+        namespace, label_selector=f"app={app_name}"
+    )
+    return len(resp.items) > 0
+
+
+def auto_migration_entry(namespace, name):
+    return auto_migration_state.setdefault(
+        f"{namespace}/{name}",
+        {"violating": False, "violations": 0, "last_migration": None},
+    )
+
+
+def deployment_service_url(deployment):
+    for config in deployment.get("configs"):
+        if config.get("kind") == "Service":
+            metadata = config.get("metadata")
+            port = config.get("spec").get("ports")[0].get("port")
+            return f"http://{metadata.get('name')}.{metadata.get('namespace', 'default')}.svc.cluster.local:{port}"
+    return None
+
+
+def get_twin_odte(service_url, logger):
+    # odte gauge from the /metrics route of the twin
+    try:
+        resp = requests.get(f"{service_url}/metrics", timeout=5)
+    except requests.RequestException:
+        logger.info("Twin not available.")
+        raise Exception
+
+    for line in resp.text.splitlines():
+        if line.startswith("odte{"):
+            return float(line.rsplit(" ", 1)[1])
+
+    logger.info("ODTE not available.")
+    raise Exception
+
+
+def measure_odte(spec, deployment, logger):
+    if prometheus_url:
+        return get_prometheus_odte(prometheus_url, spec.get("twinOf")[0], logger)
+
+    service_url = deployment_service_url(deployment)
+    if service_url is None:
+        logger.info("No service to scrape the ODTE from.")
+        raise Exception
+    return get_twin_odte(service_url, logger)
+
+
 def choose_next_deployment(deployments, current_deployment_affinity):
     """Select a new deployment avoiding the current one."""
 
+    # best scored zone of the placement engine, random before its first refresh
+    next_deployment = placement_engine.choose(deployments, current_deployment_affinity)
+    if next_deployment is not None:
+        return next_deployment
+
     available_deployments = [
         d for d in deployments if d.get("affinity") != current_deployment_affinity
     ]
     return random.choice(available_deployments) if available_deployments else None
 
 
-def ensure_pods_ready(k8s_core_v1, app_name, namespace, logger):
-    """Wait until all pods of the deployment are ready."""
+async def ensure_pods_ready(k8s_core_v1, app_name, namespace, logger, timeout=300):
+    """Wait until all pods of the deployment are ready, False on timeout."""
 
     label_selector = f"app={app_name}"
     try:
-        resp = k8s_core_v1.list_namespaced_pod(namespace, label_selector=label_selector)
-    except:
-        logger.error("Cannot list pods.")
-        return
-
-    pods = resp.items
-
-    for pod in pods:
-        pod_ready = False
-        pod_name = pod.metadata.name
-
-        while not pod_ready:
-            try:
-                pod_status = k8s_core_v1.read_namespaced_pod_status(pod_name, namespace)
-            except:
-                logger.error("Cannot read pod status.")
+        await asyncio.to_thread(
+            wait_for_pods_ready,
+            k8s_core_v1.api,
+            namespace,
+            label_selector,
+            timeout=timeout,
+            logger=logger,
+        )
+    except TimeoutError:
+        logger.error(f"Pods of {app_name} not ready after {timeout}s.")
+        return False
+    return True
 
-            conditions = pod_status.status.conditions
-            for condition in conditions:
-                if condition.type == "Ready" and condition.status == "True":
-                    pod_ready = True
 
+async def ensure_pod_termination(k8s_core_v1, app_name, namespace, logger, timeout=300):
+    """Wait until all pods of the deployment are deleted, False on timeout."""
 
-def ensure_pod_termination(k8s_core_v1, app_name, namespace, logger):
-    terminated = False
     label_selector = f"app={app_name}"
-    while not terminated:
-        try:
-            resp = k8s_core_v1.list_namespaced_pod(
-                namespace, label_selector=label_selector
-            )
-            if len(resp.items) == 0:
-                terminated = True
-        except Exception as e:
-            logger.info(f"Cannot list pods. {e}")
+    try:
+        await asyncio.to_thread(
+            wait_for_pods_deleted,
+            k8s_core_v1.api,
+            namespace,
+            label_selector,
+            timeout=timeout,
+            logger=logger,
+        )
+    except TimeoutError:
+        logger.error(f"Pods of {app_name} still present after {timeout}s.")
+        return False
+    return True
 
 
 @kopf.on.update("cyberphysicalapplications")
@@ -169,15 +481,16 @@ def update_fn(name, spec, namespace, **kwargs):
 
 
 @kopf.on.field("cyberphysicalapplications", field="spec.migrate")
-def migrate_fn(spec, namespace, meta, name, old, new, logger, **_):
+@limit_concurrency
+async def migrate_fn(spec, namespace, meta, name, old, new, logger, **_):
 
     # guard condition for creation
     if old is None:
         return
 
-    k8s_client = client.ApiClient()
-    k8s_core_v1 = client.CoreV1Api()
-    k8s_custom_object = client.CustomObjectsApi()
+    k8s_client = shared_api_client()
+    k8s_core_v1 = AsyncApi(client.CoreV1Api())
+    k8s_custom_object = AsyncApi(client.CustomObjectsApi())
 
     # trigger a migration
     if old == False and new == True:
@@ -213,6 +526,23 @@ def migrate_fn(spec, namespace, meta, name, old, new, logger, **_):
                 next_deployment_app_name = (
                     config.get("metadata").get("labels").get("app")
                 )
+                # connected once the state is restored
+                set_container_env(
+                    config,
+                    odte_env(spec.get("requirements"))
+                    + twin_env(namespace, name)
+                    + [
+                        {
+                            "name": "MIGRATED",
+                            "valueFrom": {
+                                "configMapKeyRef": {
+                                    "name": f"{next_deployment_app_name}-migrated",
+                                    "key": "migrated",
+                                }
+                            },
+                        }
+                    ],
+                )
                 annotations_patch["metadata"]["annotations"][
                     "child-deployment-namespace"
                 ] = next_deployment_namespace
@@ -238,15 +568,41 @@ def migrate_fn(spec, namespace, meta, name, old, new, logger, **_):
 
             kopf.adopt(config)
             kopf.label(config, {"related-to": f"{name}"})
+
+        # with the warm pool the target twin is already running idle
+        standby = spec.get("warmPool") and await standby_running(
+            k8s_core_v1, next_deployment_app_name, next_deployment_namespace
+        )
+        if not standby:
+            await set_migrated_flag(
+                k8s_client,
+                next_deployment_app_name,
+                next_deployment_namespace,
+                name,
+                True,
+                logger,
+            )
             try:
-                create_from_dict(k8s_client, config)
-            except:
-                logger.exception("Exception creating new object.")
+                await create_from_dicts(
+                    k8s_client,
+                    next_deployment_configs,
+                    server_side_apply=server_side_apply,
+                )
+            except FailToCreateError:
+                logger.exception("Exception creating new objects.")
 
         # wait for it to start correctly
-        ensure_pods_ready(
+        if not await ensure_pods_ready(
             k8s_core_v1, next_deployment_app_name, next_deployment_namespace, logger
-        )
+        ):
+            # nothing was transferred yet, the source keeps the twin
+            if not standby:
+                try:
+                    await delete_from_dicts(k8s_client, next_deployment_configs)
+                except FailToDeleteError:
+                    logger.exception("Exception deleting the target objects.")
+            logger.error("Migration stopped, the target instance is not ready.")
+            return
         print("Deployment's pods started.")
 
         operation_end_time = datetime.datetime.now()
@@ -257,39 +613,161 @@ def migrate_fn(spec, namespace, meta, name, old, new, logger, **_):
 
         # recover the state from the old one freezing the traffic to ensure no change in state
         label_selector = "debug=current-service"
-        resp = k8s_core_v1.list_namespaced_service(
+        resp = await k8s_core_v1.list_namespaced_service(
             current_deployment_namespace, label_selector=label_selector
         )
         current_deployment_service_port = resp.items[0].spec.ports[0].node_port
 
-        resp = k8s_core_v1.read_namespaced_service(
+        resp = await k8s_core_v1.read_namespaced_service(
             next_deployment_service_name, next_deployment_namespace
         )
         next_deployment_service_port = resp.spec.ports[0].node_port
 
-        service_url = f"http://{CLUSTER_IP}:{current_deployment_service_port}/dump"
-        resp = requests.post(service_url)
+        if state_transfer == "stream":
+            operation_name = "Transfer state to the target instance"
+
+            # pod to pod, chunked and optionally compressed
+            pull_url = f"http://{CLUSTER_IP}:{next_deployment_service_port}/pull"
+            body = {
+                "source": f"http://{CLUSTER_IP}:{current_deployment_service_port}/dump",
+                "compress": state_transfer_compression,
+                "precopy": state_transfer_precopy,
+            }
+            transfer = None
+            try:
+                async with http_session.post(pull_url, json=body) as resp:
+                    if resp.status == 201:
+                        transfer = await resp.json()
+                    else:
+                        logger.error(
+                            f"State transfer failed ({resp.status}): {await resp.text()}"
+                        )
+            except aiohttp.ClientError:
+                logger.exception("Exception transferring the state.")
+
+            if transfer is None:
+                await abort_migration(
+                    k8s_client,
+                    current_deployment_service_port,
+                    next_deployment_configs,
+                    standby,
+                    logger,
+                )
+                return
 
-        # measuring purposes
-        json_object = json.dumps(json.loads(resp.text)).encode("UTF-8")
-        print(
-            f"Size in megabytes of the received state encoded in UTF-8: {len(json_object) / 1024 / 1024}"
-        )
-        print(f"No. of messages {len(json.loads(resp.text)["dump"]["messages_deque"])}")
+            # measuring purposes
+            print(
+                f"Size in megabytes of the transferred state: {transfer.get('bytes', 0) / 1024 / 1024}"
+            )
+            print(f"No. of messages {transfer.get('messages')}")
+            if state_transfer_precopy:
+                print(f"Entries copied per pre-copy round {transfer.get('rounds')}")
 
-        operation_end_time = datetime.datetime.now()
-        timestamps.append([operation_name, operation_start_time, operation_end_time])
+        else:
+            service_url = f"http://{CLUSTER_IP}:{current_deployment_service_port}/dump"
+            dump = None
+            try:
+                async with http_session.post(service_url) as resp:
+                    if resp.status == 201:
+                        dump = await resp.text()
+                    else:
+                        logger.error(
+                            f"State dump failed ({resp.status}): {await resp.text()}"
+                        )
+            except aiohttp.ClientError:
+                logger.exception("Exception dumping the state.")
+
+            if dump is None:
+                await abort_migration(
+                    k8s_client,
+                    current_deployment_service_port,
+                    next_deployment_configs,
+                    standby,
+                    logger,
+                )
+                return
 
-        operation_name = "Restore state on the target instance"
-        operation_start_time = operation_end_time
+            # measuring purposes
+            json_object = json.dumps(json.loads(dump)).encode("UTF-8")
+            print(
+                f"Size in megabytes of the received state encoded in UTF-8: {len(json_object) / 1024 / 1024}"
+            )
+            print(f"No. of messages {len(json.loads(dump)["dump"]["messages_deque"])}")
+
+            operation_end_time = datetime.datetime.now()
+            timestamps.append([operation_name, operation_start_time, operation_end_time])
+
+            operation_name = "Restore state on the target instance"
+            operation_start_time = operation_end_time
 
-        # restore the state in the new instance
-        next_service_url = f"http://{CLUSTER_IP}:{next_deployment_service_port}/restore"
-        headers = {"Content-Type": "application/json"}
+            # restore the state in the new instance
+            next_service_url = f"http://{CLUSTER_IP}:{next_deployment_service_port}/restore"
+            headers = {"Content-Type": "application/json"}
 
-        data = resp.text
-        resp = requests.post(next_service_url, data=data, headers=headers)
-        print(resp.text)
+            data = dump
+            restored = False
+            try:
+                async with http_session.post(
+                    next_service_url, data=data, headers=headers
+                ) as resp:
+                    print(await resp.text())
+                    restored = resp.status == 201
+            except aiohttp.ClientError:
+                logger.exception("Exception restoring the state.")
+
+            if not restored:
+                await abort_migration(
+                    k8s_client,
+                    current_deployment_service_port,
+                    next_deployment_configs,
+                    standby,
+                    logger,
+                )
+                return
+
+        # restored, a restart of the target twin connects it
+        if not standby:
+            await set_migrated_flag(
+                k8s_client,
+                next_deployment_app_name,
+                next_deployment_namespace,
+                name,
+                False,
+                logger,
+            )
+
+        # connect the standby instance to the broker once restored
+        if standby:
+            bind_url = f"http://{CLUSTER_IP}:{next_deployment_service_port}/bind"
+            bound = False
+            try:
+                async with http_session.post(bind_url) as resp:
+                    print(await resp.text())
+                    bound = resp.status == 201
+            except aiohttp.ClientError:
+                logger.exception("Exception binding standby instance.")
+
+            # the state is on the standby only, the source takes the twin back
+            if not bound:
+                await abort_migration(
+                    k8s_client,
+                    current_deployment_service_port,
+                    next_deployment_configs,
+                    standby,
+                    logger,
+                )
+                return
+
+            # a restart of the bound twin keeps it active
+            await set_standby_flags(
+                k8s_client,
+                [
+                    standby_flag(
+                        next_deployment_app_name, next_deployment_namespace, name, False
+                    )
+                ],
+                logger,
+            )
 
         operation_end_time = datetime.datetime.now()
         timestamps.append([operation_name, operation_start_time, operation_end_time])
@@ -303,15 +781,19 @@ def migrate_fn(spec, namespace, meta, name, old, new, logger, **_):
         # delete old instance
         for depl in deployments:
             if depl.get("affinity") == current_deployment_affinity:
-                for config in depl.get("configs"):
-                    delete_from_dict(k8s_client, config)
+                try:
+                    await delete_from_dicts(k8s_client, depl.get("configs"))
+                except FailToDeleteError:
+                    logger.exception("Exception deleting old objects.")
 
-        ensure_pod_termination(k8s_core_v1, current_deployment_app_name, namespace, logger)
+        terminated = await ensure_pod_termination(
+            k8s_core_v1, current_deployment_app_name, namespace, logger
+        )
         operation_end_time = datetime.datetime.now()
         timestamps.append([operation_name, operation_start_time, operation_end_time])
 
         kopf.label(next_deployment_service, {"debug": "current-service"})
-        resp = k8s_core_v1.patch_namespaced_service(
+        resp = await k8s_core_v1.patch_namespaced_service(
             next_deployment_service_name,
             next_deployment_namespace,
             next_deployment_service,
@@ -320,10 +802,94 @@ def migrate_fn(spec, namespace, meta, name, old, new, logger, **_):
         group = "test.dev"
         version = "v1"
         plural = "cyberphysicalapplications"
-        resp = k8s_custom_object.patch_namespaced_custom_object(
+        resp = await k8s_custom_object.patch_namespaced_custom_object(
             group, version, namespace, plural, name, body=annotations_patch
         )
 
+        auto_migration_entry(meta.get("namespace"), name)[
+            "last_migration"
+        ] = time.monotonic()
         generate_chart(timestamps)
 
+        # the twin is on the target, but a standby can not replace pods still running
+        if not terminated:
+            logger.error("Warm pool not refilled, the source pods are still running.")
+            return
+
+        # refill the warm pool, off the critical path
+        if spec.get("warmPool"):
+            await create_standby_instances(
+                k8s_client,
+                spec,
+                name,
+                namespace,
+                [current_deployment_affinity],
+                logger,
+            )
+
+        return
+
+
+@kopf.timer(
+    "cyberphysicalapplications",
+    interval=auto_migration_interval,
+    when=lambda spec, **_: (spec.get("autoMigration") or {}).get("enabled", False),
+)
+async def auto_migrate_fn(spec, name, logger, meta, namespace, **kwargs):
+    parameters = spec.get("autoMigration")
+    threshold = (spec.get("requirements") or {}).get("odte")
+    if threshold is None:
         return
+
+    state = auto_migration_entry(namespace, name)
+    deployments = spec.get("deployments")
+
+    current_deployment_affinity = (meta.get("annotations") or {}).get(
+        "child-deployment-affinity"
+    )
+    current_deployment = None
+    for deployment in deployments:
+        if deployment.get("affinity") == current_deployment_affinity:
+            current_deployment = deployment
+    if current_deployment is None:
+        return
+
+    try:
+        odte = await asyncio.to_thread(measure_odte, spec, current_deployment, logger)
+    except Exception:
+        return
+
+    # violating below the requirement, back to normal only above requirement + hysteresis
+    if odte < threshold:
+        state["violating"] = True
+    elif odte >= threshold + parameters.get("hysteresis", 0.05):
+        state["violating"] = False
+    state["violations"] = state["violations"] + 1 if state["violating"] else 0
+
+    if state["violations"] < parameters.get("violations", 3):
+        return
+
+    last_migration = state["last_migration"]
+    if (
+        last_migration is not None
+        and time.monotonic() - last_migration < parameters.get("cooldown", 300)
+    ):
+        logger.info(f"ODTE {odte} violates the requirement {threshold}, migration in cooldown.")
+        return
+
+    lock = migration_locks.get(f"{namespace}/{name}")
+    if lock is not None and lock.locked():
+        return
+
+    logger.info(f"ODTE {odte} violates the requirement {threshold}, migrating.")
+    state["violating"] = False
+    state["violations"] = 0
+    await migrate_fn(
+        spec=spec,
+        name=name,
+        old=False,
+        new=True,
+        logger=logger,
+        meta=meta,
+        namespace=namespace,
+    )
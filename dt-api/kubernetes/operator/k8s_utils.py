@@ -1,11 +1,175 @@
-import kopf, requests, json, random, re, yaml, time
-from kubernetes import client
+import re
+import time
+import asyncio
+import threading
+import weakref
+from kubernetes import client, dynamic, watch
+from kubernetes.utils import FailToCreateError
 
 UPPER_FOLLOWED_BY_LOWER_RE = re.compile('(.)([A-Z][a-z]+)')
 UPPER_FOLLOWED_BY_LOWER_RE = re.compile('(.)([A-Z][a-z]+)')
 LOWER_OR_NUM_FOLLOWED_BY_UPPER_RE = re.compile('([a-z0-9])([A-Z])')
 LOWER_OR_NUM_FOLLOWED_BY_UPPER_RE = re.compile('([a-z0-9])([A-Z])')
 
+# (apiVersion, kind) -> (typed api class or None, snake_case kind)
+_api_classes = {}
+# per ApiClient: api instances, bound methods, dynamic client and resources
+_client_caches = weakref.WeakKeyDictionary()
+_cache_lock = threading.Lock()
+_shared_api_client = None
+
+
+def shared_api_client():
+    # a single ApiClient for all the handlers, so connections and the
+    # resolved apis below are reused across twins
+    global _shared_api_client
+    with _cache_lock:
+        if _shared_api_client is None:
+            _shared_api_client = client.ApiClient()
+        return _shared_api_client
+
+
+def resolve_api_class(api_version, kind):
+    resolved = _api_classes.get((api_version, kind))
+    if resolved is not None:
+        return resolved
+
+    group, _, version = api_version.partition("/")
+    if version == "":
+        version = group
+        group = "core"
+    # Take care for the case e.g. api_type is "apiextensions.k8s.io"
+    # Only replace the last instance
+    group = "".join(group.rsplit(".k8s.io", 1))
+    # convert group name from DNS subdomain format to
+    # python class name convention
+    group = "".join(word.capitalize() for word in group.split('.'))
+    fcn_to_call = "{0}{1}Api".format(group, version.capitalize())
+    # Replace CamelCased action_type into snake_case
+    snake_kind = UPPER_FOLLOWED_BY_LOWER_RE.sub(r'\1_\2', kind)
+    snake_kind = LOWER_OR_NUM_FOLLOWED_BY_UPPER_RE.sub(
+        r'\1_\2', snake_kind).lower()
+
+    resolved = (getattr(client, fcn_to_call, None), snake_kind)
+    _api_classes[(api_version, kind)] = resolved
+    return resolved
+
+
+def client_cache(k8s_client):
+    with _cache_lock:
+        cache = _client_caches.get(k8s_client)
+        if cache is None:
+            cache = {"apis": {}, "methods": {}, "resources": {},
+                     "dynamic": None}
+            _client_caches[k8s_client] = cache
+        return cache
+
+
+def resolve_api_method(k8s_client, api_version, kind, action):
+    # (namespaced, bound method) of the typed api for action ("create",
+    # "delete") on kind, or (None, None) when there is no typed api
+    cache = client_cache(k8s_client)
+    key = (api_version, kind, action)
+    resolved = cache["methods"].get(key)
+    if resolved is not None:
+        return resolved
+
+    api_class, snake_kind = resolve_api_class(api_version, kind)
+    resolved = (None, None)
+    if api_class is not None:
+        k8s_api = cache["apis"].get(api_class)
+        if k8s_api is None:
+            k8s_api = cache["apis"].setdefault(
+                api_class, api_class(k8s_client))
+        method = getattr(
+            k8s_api, "{0}_namespaced_{1}".format(action, snake_kind), None)
+        if method is not None:
+            resolved = (True, method)
+        else:
+            resolved = (False, getattr(
+                k8s_api, "{0}_{1}".format(action, snake_kind)))
+
+    cache["methods"][key] = resolved
+    return resolved
+
+
+def dynamic_client(k8s_client):
+    cache = client_cache(k8s_client)
+    with _cache_lock:
+        if cache["dynamic"] is None:
+            # discovery is expensive, done once per ApiClient
+            cache["dynamic"] = dynamic.DynamicClient(k8s_client)
+        return cache["dynamic"]
+
+
+def resolve_resource(k8s_client, api_version, kind):
+    cache = client_cache(k8s_client)
+    resource = cache["resources"].get((api_version, kind))
+    if resource is None:
+        resource = dynamic_client(k8s_client).resources.get(
+            api_version=api_version, kind=kind)
+        cache["resources"][(api_version, kind)] = resource
+    return resource
+
+
+def create_from_dict(k8s_client, data, verbose=False, namespace='default',
+                     **kwargs):
+    # Same as kubernetes.utils.create_from_dict, through the cached resolver
+    # and with the dynamic client for kinds without a typed api.
+    api_exceptions = []
+    k8s_objects = []
+
+    if "List" in data["kind"]:
+        kind = data["kind"].replace("List", "")
+        for yml_object in data["items"]:
+            if kind != "":
+                yml_object["apiVersion"] = data["apiVersion"]
+                yml_object["kind"] = kind
+            try:
+                created = create_from_yaml_single_item(
+                    k8s_client, yml_object, verbose, namespace=namespace,
+                    **kwargs)
+                k8s_objects.append(created)
+            except client.rest.ApiException as api_exception:
+                api_exceptions.append(api_exception)
+    else:
+        try:
+            created = create_from_yaml_single_item(
+                k8s_client, data, verbose, namespace=namespace, **kwargs)
+            k8s_objects.append(created)
+        except client.rest.ApiException as api_exception:
+            api_exceptions.append(api_exception)
+
+    if api_exceptions:
+        raise FailToCreateError(api_exceptions)
+
+    return k8s_objects
+
+
+def create_from_yaml_single_item(
+        k8s_client, yml_object, verbose=False, **kwargs):
+    kind = yml_object["kind"]
+    namespaced, method = resolve_api_method(
+        k8s_client, yml_object["apiVersion"], kind, "create")
+    if "namespace" in yml_object["metadata"]:
+        kwargs['namespace'] = yml_object["metadata"]["namespace"]
+    if method is None:
+        resource = resolve_resource(
+            k8s_client, yml_object["apiVersion"], kind)
+        if not resource.namespaced:
+            kwargs.pop('namespace', None)
+        resp = dynamic_client(k8s_client).create(
+            resource, body=yml_object, **kwargs)
+    elif namespaced:
+        resp = method(body=yml_object, **kwargs)
+    else:
+        kwargs.pop('namespace', None)
+        resp = method(body=yml_object, **kwargs)
+    if verbose:
+        print("{0} created.".format(kind))
+    return resp
+
+
 
 def delete_from_dict(k8s_client, data, verbose=False, namespace='default',
                      **kwargs):
@@ -47,24 +211,22 @@ def delete_from_dict(k8s_client, data, verbose=False, namespace='default',
 
 def delete_from_yaml_single_item(
         k8s_client, yml_object, verbose=False, **kwargs):
-    group, _, version = yml_object["apiVersion"].partition("/")
-    if version == "":
-        version = group
-        group = "core"
-    # Take care for the case e.g. api_type is "apiextensions.k8s.io"
-    # Only replace the last instance
-    group = "".join(group.rsplit(".k8s.io", 1))
-    # convert group name from DNS subdomain format to
-    # python class name convention
-    group = "".join(word.capitalize() for word in group.split('.'))
-    fcn_to_call = "{0}{1}Api".format(group, version.capitalize())
-    k8s_api = getattr(client, fcn_to_call)(k8s_client)
-    # Replace CamelCased action_type into snake_case
     kind = yml_object["kind"]
-    kind = UPPER_FOLLOWED_BY_LOWER_RE.sub(r'\1_\2', kind)
-    kind = LOWER_OR_NUM_FOLLOWED_BY_UPPER_RE.sub(r'\1_\2', kind).lower()
+    namespaced, method = resolve_api_method(
+        k8s_client, yml_object["apiVersion"], kind, "delete")
+    if method is None:
+        # no typed api, e.g. custom resources such as VirtualServices
+        resource = resolve_resource(
+            k8s_client, yml_object["apiVersion"], kind)
+        if resource.namespaced:
+            kwargs['namespace'] = yml_object["metadata"].get(
+                "namespace", kwargs.get('namespace'))
+        else:
+            kwargs.pop('namespace', None)
+        resp = dynamic_client(k8s_client).delete(
+            resource, name=yml_object["metadata"]["name"], **kwargs)
     # Expect the user to create namespaced objects more often
-    if hasattr(k8s_api, "delete_namespaced_{0}".format(kind)):
+    elif namespaced:
         # Decide which namespace we are going to put the object in,
         # if any
         if "namespace" in yml_object["metadata"]:
@@ -73,11 +235,11 @@ def delete_from_yaml_single_item(
         if "name" in yml_object["metadata"]:
             name = yml_object["metadata"]["name"]
             kwargs['name'] = name
-        resp = getattr(k8s_api, "delete_namespaced_{0}".format(kind))(**kwargs)
+        resp = method(**kwargs)
     else:
         kwargs.pop('namespace', None)
         kwargs.pop('name', None)
-        resp = getattr(k8s_api, "delete_{0}".format(kind))(**kwargs)
+        resp = method(**kwargs)
     if verbose:
         msg = "{0} deleted.".format(kind)
         if hasattr(resp, 'status'):
@@ -95,3 +257,158 @@ class FailToDeleteError(Exception):
             msg += "Error from server ({0}): {1}".format(
                 api_exception.reason, api_exception.body)
         return msg
+
+
+class AsyncApi:
+    # Exposes the methods of a blocking Kubernetes API object as coroutines
+    # running in the default executor, so handlers do not block the loop.
+    def __init__(self, api):
+        self.api = api
+
+    def __getattr__(self, attr):
+        method = getattr(self.api, attr)
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(method, *args, **kwargs)
+
+        return call
+
+
+def pod_ready(pod):
+    if pod.status is None or pod.status.conditions is None:
+        return False
+    for condition in pod.status.conditions:
+        if condition.type == "Ready" and condition.status == "True":
+            return True
+    return False
+
+
+def wait_for_pods(k8s_core_v1, namespace, label_selector, condition,
+                  timeout=300, backoff=0.5, max_backoff=8, logger=None):
+    # List the pods once, then follow them through a watch stream starting
+    # from the list resourceVersion, so the API server is not polled. Errors
+    # (e.g. 410 Gone) restart from a fresh list after an exponential backoff.
+    deadline = time.monotonic() + timeout
+    delay = backoff
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(
+                "Timeout waiting for pods '{0}' in namespace '{1}'".format(
+                    label_selector, namespace))
+
+        try:
+            resp = k8s_core_v1.list_namespaced_pod(
+                namespace, label_selector=label_selector)
+            pods = {pod.metadata.name: pod for pod in resp.items}
+            if condition(list(pods.values())):
+                return
+
+            pod_watch = watch.Watch()
+            for event in pod_watch.stream(
+                    k8s_core_v1.list_namespaced_pod, namespace,
+                    label_selector=label_selector,
+                    resource_version=resp.metadata.resource_version,
+                    timeout_seconds=max(1, int(remaining))):
+                pod = event["object"]
+                if event["type"] == "DELETED":
+                    pods.pop(pod.metadata.name, None)
+                else:
+                    pods[pod.metadata.name] = pod
+
+                if condition(list(pods.values())):
+                    pod_watch.stop()
+                    return
+            delay = backoff
+        except Exception as e:
+            if logger is not None:
+                logger.warning("Watch on pods '{0}' failed, retrying in {1}s. {2}".format(
+                    label_selector, delay, e))
+            time.sleep(min(delay, max(0, deadline - time.monotonic())))
+            delay = min(delay * 2, max_backoff)
+
+
+def wait_for_pods_ready(k8s_core_v1, namespace, label_selector, timeout=300,
+                        logger=None):
+    wait_for_pods(
+        k8s_core_v1, namespace, label_selector,
+        lambda pods: len(pods) > 0 and all(pod_ready(pod) for pod in pods),
+        timeout=timeout, logger=logger)
+
+
+def wait_for_pods_deleted(k8s_core_v1, namespace, label_selector, timeout=300,
+                          logger=None):
+    wait_for_pods(
+        k8s_core_v1, namespace, label_selector,
+        lambda pods: len(pods) == 0,
+        timeout=timeout, logger=logger)
+
+
+def apply_from_dict(k8s_client, data, field_manager="cpa-operator"):
+    # server-side apply, unlike create it is idempotent and can be retried
+    resource = resolve_resource(k8s_client, data["apiVersion"], data["kind"])
+    namespace = None
+    if resource.namespaced:
+        namespace = data["metadata"].get("namespace", "default")
+    return dynamic_client(k8s_client).server_side_apply(
+        resource, body=data, name=data["metadata"]["name"],
+        namespace=namespace, field_manager=field_manager,
+        force_conflicts=True)
+
+
+def collect_results(results, api_exceptions):
+    # split the outcome of gathered calls into objects and api exceptions
+    k8s_objects = []
+    for result in results:
+        if isinstance(result, (FailToCreateError, FailToDeleteError)):
+            api_exceptions.extend(result.api_exceptions)
+        elif isinstance(result, client.rest.ApiException):
+            api_exceptions.append(result)
+        elif isinstance(result, BaseException):
+            raise result
+        elif isinstance(result, list):
+            k8s_objects.extend(result)
+        else:
+            k8s_objects.append(result)
+    return k8s_objects
+
+
+async def create_from_dicts(k8s_client, configs, server_side_apply=False,
+                            field_manager="cpa-operator"):
+    # The objects are independent, so they are created concurrently. The
+    # api exceptions of all of them are raised together at the end.
+    if server_side_apply:
+        await asyncio.to_thread(dynamic_client, k8s_client)
+        calls = [
+            asyncio.to_thread(apply_from_dict, k8s_client, config,
+                              field_manager)
+            for config in configs
+        ]
+    else:
+        calls = [
+            asyncio.to_thread(create_from_dict, k8s_client, config)
+            for config in configs
+        ]
+
+    api_exceptions = []
+    results = await asyncio.gather(*calls, return_exceptions=True)
+    k8s_objects = collect_results(results, api_exceptions)
+    if api_exceptions:
+        raise FailToCreateError(api_exceptions)
+
+    return k8s_objects
+
+
+async def delete_from_dicts(k8s_client, configs, **kwargs):
+    api_exceptions = []
+    results = await asyncio.gather(
+        *[
+            asyncio.to_thread(delete_from_dict, k8s_client, config, **kwargs)
+            for config in configs
+        ],
+        return_exceptions=True)
+    k8s_objects = collect_results(results, api_exceptions)
+    if api_exceptions:
+        raise FailToDeleteError(api_exceptions)
+
+    return k8s_objects
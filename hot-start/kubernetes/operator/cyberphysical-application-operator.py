@@ -1,14 +1,67 @@
-import kopf, requests, json, random, yaml, time, datetime
+import kopf, requests, json, random, yaml, time, datetime, os, copy
+import asyncio, functools, concurrent.futures
 from kubernetes import client
-from kubernetes.utils import create_from_dict
-from k8s_utils import delete_from_dict
+from k8s_utils import (
+    AsyncApi,
+    shared_api_client,
+    FailToCreateError,
+    FailToDeleteError,
+    create_from_dicts,
+    delete_from_dicts,
+    wait_for_pods_ready,
+    wait_for_pods_deleted,
+)
 from graph_utils import generate_chart
+from placement_utils import default_engine
+
+
+# migrations running at the same time, across all the CPAs
+max_concurrent_migrations = int(os.environ.get("MAX_CONCURRENT_MIGRATIONS", 10))
+migration_semaphore = asyncio.Semaphore(max_concurrent_migrations)
+# a CPA is migrated by one handler at a time
+migration_locks = {}
+# autonomous migrations, ODTE of the twins read from Prometheus if set, else from /metrics
+auto_migration_interval = float(os.environ.get("AUTO_MIGRATION_INTERVAL", 30))
+prometheus_url = os.environ.get("PROMETHEUS_URL")
+# per CPA: violations of the requirement, end of the last migration
+auto_migration_state = {}
+# scores the target zones of the migrations, refreshed in the background
+placement_engine = default_engine(
+    refresh_interval=float(os.environ.get("PLACEMENT_REFRESH_INTERVAL", 30))
+)
+# create the twin objects with server-side apply instead of create
+server_side_apply = os.environ.get("SERVER_SIDE_APPLY", "false").lower() == "true"
+
+
+@kopf.on.startup()
+async def startup_fn(logger, **kwargs):
+    # blocking Kubernetes calls of the migrations run in the default executor
+    asyncio.get_running_loop().set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_migrations * 2)
+    )
+    placement_engine.start(logger)
+
+
+@kopf.on.cleanup()
+async def cleanup_fn(**kwargs):
+    placement_engine.stop()
+
+
+def limit_concurrency(handler):
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        key = f"{kwargs.get('namespace')}/{kwargs.get('name')}"
+        lock = migration_locks.setdefault(key, asyncio.Lock())
+        async with lock, migration_semaphore:
+            return await handler(*args, **kwargs)
+
+    return wrapper
 
 
 @kopf.on.create("cyberphysicalapplications")
-def create_fn(spec, name, logger, meta, **kwargs):
-    k8s_client = client.ApiClient()
-    k8s_custom_object = client.CustomObjectsApi()
+async def create_fn(spec, name, logger, meta, **kwargs):
+    k8s_client = shared_api_client()
+    k8s_custom_object = AsyncApi(client.CustomObjectsApi())
 
     deployments = spec.get("deployments")
     preferred_affinity = spec.get("requirements").get("preferredAffinity")
@@ -35,6 +88,7 @@ def create_fn(spec, name, logger, meta, **kwargs):
             config["spec"]["template"]["spec"].update(
                 {"nodeSelector": {"zone": f"{deployment_affinity}"}}
             )
+            set_container_env(config, odte_env(spec.get("requirements")))
             deployment_namespace = config.get("metadata").get("namespace")
             deployment_app_name = config.get("metadata").get("labels").get("app")
             deployment_prometheus_url = (
@@ -60,16 +114,33 @@ def create_fn(spec, name, logger, meta, **kwargs):
             version = "v1"
             namespace = "default"
             plural = "virtualservices"
-            k8s_custom_object.create_namespaced_custom_object(
+            await k8s_custom_object.create_namespaced_custom_object(
                 group, version, namespace, plural, body=data
             )
 
         kopf.label(config, {"related-to": f"{name}"})
         kopf.adopt(config)
-        try:
-            create_from_dict(k8s_client, config)
-        except Exception as e:
-            logger.exception("Exception in object creation.")
+
+    try:
+        await create_from_dicts(
+            k8s_client, deployment_configs, server_side_apply=server_side_apply
+        )
+    except FailToCreateError:
+        logger.exception("Exception in object creation.")
+
+    # warm pool, an idle twin on every other candidate affinity
+    if spec.get("warmPool"):
+        await create_standby_instances(
+            k8s_client,
+            spec,
+            name,
+            [
+                deployment.get("affinity")
+                for deployment in deployments
+                if deployment.get("affinity") != deployment_affinity
+            ],
+            logger,
+        )
 
     annotations_patch = {"metadata": {"annotations": dict(meta.annotations)}}
     annotations_patch["metadata"]["annotations"][
@@ -88,7 +159,7 @@ def create_fn(spec, name, logger, meta, **kwargs):
     group = "test.dev"
     version = "v1"
     plural = "cyberphysicalapplications"
-    resp = k8s_custom_object.patch_namespaced_custom_object(
+    resp = await k8s_custom_object.patch_namespaced_custom_object(
         group, version, namespace, plural, name, body=annotations_patch
     )
 
@@ -114,7 +185,133 @@ def get_prometheus_odte(prometheus_url, twin_of, logger):
     return odte
 
 
+def odte_env(requirements):
+    # ODTE parameters of the twin, taken from spec.requirements
+    env = []
+    if requirements is None:
+        return env
+
+    if requirements.get("odte") is not None:
+        env.append({"name": "ODTE_THRESHOLD", "value": str(requirements.get("odte"))})
+
+    parameters = requirements.get("odteParameters") or {}
+    parameters_env = {
+        "windowLength": "ODTE_WINDOW_LENGTH",
+        "desiredTimeliness": "ODTE_DESIRED_TIMELINESS",
+        "expectedMsgRate": "ODTE_EXPECTED_MSG_RATE",
+    }
+    for field, env_name in parameters_env.items():
+        if parameters.get(field) is not None:
+            env.append({"name": env_name, "value": str(parameters.get(field))})
+
+    if parameters.get("windows"):
+        env.append(
+            {
+                "name": "ODTE_WINDOWS",
+                "value": ",".join(str(window) for window in parameters.get("windows")),
+            }
+        )
+
+    return env
+
+
+def set_container_env(config, env):
+    container = config["spec"]["template"]["spec"]["containers"][0]
+    names = [var.get("name") for var in env]
+    container["env"] = [
+        var for var in container.get("env", []) if var.get("name") not in names
+    ] + env
+
+
+def standby_configs(deployment, spec, name):
+    # copies of the configs of an affinity, for an idle instance of the warm pool
+    affinity = deployment.get("affinity")
+    configs = copy.deepcopy(deployment.get("configs"))
+    for config in configs:
+        if config.get("kind") == "Deployment":
+            config["spec"]["template"]["spec"].update(
+                {"nodeSelector": {"zone": f"{affinity}"}}
+            )
+            set_container_env(
+                config,
+                odte_env(spec.get("requirements"))
+                + [{"name": "STANDBY", "value": "true"}],
+            )
+
+        kopf.label(config, {"related-to": f"{name}"})
+        kopf.adopt(config)
+
+    return configs
+
+
+async def create_standby_instances(k8s_client, spec, name, affinities, logger):
+    configs = []
+    for deployment in spec.get("deployments"):
+        if deployment.get("affinity") in affinities:
+            configs += standby_configs(deployment, spec, name)
+
+    try:
+        await create_from_dicts(k8s_client, configs, server_side_apply=server_side_apply)
+    except FailToCreateError:
+        logger.exception("Exception creating standby instances.")
+
+
+async def standby_running(k8s_core_v1, app_name, namespace):
+    resp = await k8s_core_v1.list_namespaced_pod(
+        namespace, label_selector=f"app={app_name}"
+    )
+    return len(resp.items) > 0
+
+
+def auto_migration_entry(namespace, name):
+    return auto_migration_state.setdefault(
+        f"{namespace}/{name}",
+        {"violating": False, "violations": 0, "last_migration": None},
+    )
+
+
+def deployment_service_url(deployment):
+    for config in deployment.get("configs"):
+        if config.get("kind") == "Service":
+            metadata = config.get("metadata")
+            port = config.get("spec").get("ports")[0].get("port")
+            return f"http://{metadata.get('name')}.{metadata.get('namespace', 'default')}.svc.cluster.local:{port}"
+    return None
+
+
+def get_twin_odte(service_url, logger):
+    # odte gauge from the /metrics route of the twin
+    try:
+        resp = requests.get(f"{service_url}/metrics", timeout=5)
+    except requests.RequestException:
+        logger.info("Twin not available.")
+        raise Exception
+
+    for line in resp.text.splitlines():
+        if line.startswith("odte{"):
+            return float(line.rsplit(" ", 1)[1])
+
+    logger.info("ODTE not available.")
+    raise Exception
+
+
+def measure_odte(spec, deployment, logger):
+    if prometheus_url:
+        return get_prometheus_odte(prometheus_url, spec.get("twinOf")[0], logger)
+
+    service_url = deployment_service_url(deployment)
+    if service_url is None:
+        logger.info("No service to scrape the ODTE from.")
+        raise Exception
+    return get_twin_odte(service_url, logger)
+
+
 def choose_next_deployment(deployments, current_deployment_affinity):
+    # best scored zone of the placement engine, random before its first refresh
+    next_deployment = placement_engine.choose(deployments, current_deployment_affinity)
+    if next_deployment is not None:
+        return next_deployment
+
     next_depl_index = random.randint(0, len(deployments) - 1)
     next_depl_affinity = deployments[next_depl_index].get("affinity")
 
@@ -125,46 +322,42 @@ def choose_next_deployment(deployments, current_deployment_affinity):
     return deployments[next_depl_index]
 
 
-def ensure_pods_ready(k8s_core_v1, app_name, namespace, logger):
-    """Wait until all pods of the deployment are ready."""
+async def ensure_pods_ready(k8s_core_v1, app_name, namespace, logger, timeout=300):
+    """Wait until all pods of the deployment are ready, False on timeout."""
 
     label_selector = f"app={app_name}"
     try:
-        resp = k8s_core_v1.list_namespaced_pod(namespace, label_selector=label_selector)
-    except:
-        logger.error("Cannot list pods.")
-        return
-
-    pods = resp.items
-
-    for pod in pods:
-        pod_ready = False
-        pod_name = pod.metadata.name
-
-        while not pod_ready:
-            try:
-                pod_status = k8s_core_v1.read_namespaced_pod_status(pod_name, namespace)
-            except:
-                logger.error("Cannot read pod status.")
+        await asyncio.to_thread(
+            wait_for_pods_ready,
+            k8s_core_v1.api,
+            namespace,
+            label_selector,
+            timeout=timeout,
+            logger=logger,
+        )
+    except TimeoutError:
+        logger.error(f"Pods of {app_name} not ready after {timeout}s.")
+        return False
+    return True
 
-            conditions = pod_status.status.conditions
-            for condition in conditions:
-                if condition.type == "Ready" and condition.status == "True":
-                    pod_ready = True
 
+async def ensure_pod_termination(k8s_core_v1, app_name, namespace, logger, timeout=300):
+    """Wait until all pods of the deployment are deleted, False on timeout."""
 
-def ensure_pod_termination(k8s_core_v1, app_name, namespace, logger):
-    terminated = False
     label_selector = f"app={app_name}"
-    while not terminated:
-        try:
-            resp = k8s_core_v1.list_namespaced_pod(
-                namespace, label_selector=label_selector
-            )
-            if len(resp.items) == 0:
-                terminated = True
-        except:
-            logger.info("Cannot list pods.")
+    try:
+        await asyncio.to_thread(
+            wait_for_pods_deleted,
+            k8s_core_v1.api,
+            namespace,
+            label_selector,
+            timeout=timeout,
+            logger=logger,
+        )
+    except TimeoutError:
+        logger.error(f"Pods of {app_name} still present after {timeout}s.")
+        return False
+    return True
 
 
 @kopf.on.update("cyberphysicalapplications")
@@ -183,15 +376,16 @@ def update_fn(name, spec, namespace, **kwargs):
 
 
 @kopf.on.field("cyberphysicalapplications", field="spec.migrate")
-def migrate_fn(spec, name, meta, old, new, logger, **_):
+@limit_concurrency
+async def migrate_fn(spec, name, meta, old, new, logger, **_):
 
     # guard condition for creation
     if old is None:
         return
 
-    k8s_client = client.ApiClient()
-    k8s_core_v1 = client.CoreV1Api()
-    k8s_custom_object = client.CustomObjectsApi()
+    k8s_client = shared_api_client()
+    k8s_core_v1 = AsyncApi(client.CoreV1Api())
+    k8s_custom_object = AsyncApi(client.CustomObjectsApi())
 
     # trigger a migration
     if old == False and new == True:
@@ -220,6 +414,7 @@ def migrate_fn(spec, name, meta, old, new, logger, **_):
                 config["spec"]["template"]["spec"].update(
                     {"nodeSelector": {"zone": f"{next_deployment_affinity}"}}
                 )
+                set_container_env(config, odte_env(spec.get("requirements")))
                 next_deployment_namespace = config.get("metadata").get("namespace")
                 next_deployment_app_name = (
                     config.get("metadata").get("labels").get("app")
@@ -249,14 +444,32 @@ def migrate_fn(spec, name, meta, old, new, logger, **_):
 
             kopf.adopt(config)
             kopf.label(config, {"related-to": f"{name}"})
+
+        # with the warm pool the target twin is already running idle
+        standby = spec.get("warmPool") and await standby_running(
+            k8s_core_v1, next_deployment_app_name, next_deployment_namespace
+        )
+        if not standby:
             try:
-                create_from_dict(k8s_client, config)
-            except:
-                logger.exception("Exception creating new object.")
+                await create_from_dicts(
+                    k8s_client,
+                    next_deployment_configs,
+                    server_side_apply=server_side_apply,
+                )
+            except FailToCreateError:
+                logger.exception("Exception creating new objects.")
 
-        ensure_pods_ready(
+        if not await ensure_pods_ready(
             k8s_core_v1, next_deployment_app_name, next_deployment_namespace, logger
-        )
+        ):
+            # no traffic is mirrored yet, the source keeps the twin
+            if not standby:
+                try:
+                    await delete_from_dicts(k8s_client, next_deployment_configs)
+                except FailToDeleteError:
+                    logger.exception("Exception deleting the target objects.")
+            logger.error("Migration stopped, the target instance is not ready.")
+            return
         operation_end_time = datetime.datetime.now()
         timestamps.append([operation_name, operation_start_time, operation_end_time])
 
@@ -269,8 +482,10 @@ def migrate_fn(spec, name, meta, old, new, logger, **_):
         namespace = "default"
         plural = "virtualservices"
         label_selector = f"related-to={name}"
-        virtual_service = k8s_custom_object.list_namespaced_custom_object(
-            group, version, namespace, plural, label_selector=label_selector
+        virtual_service = (
+            await k8s_custom_object.list_namespaced_custom_object(
+                group, version, namespace, plural, label_selector=label_selector
+            )
         ).get("items")[0]
         vs_name = virtual_service.get("metadata").get("name")
         vs_http_rule = virtual_service["spec"]["http"]
@@ -287,7 +502,7 @@ def migrate_fn(spec, name, meta, old, new, logger, **_):
             rule.update({"mirrorPercentage": {"value": 100.0}})
             vs_http_rule_new.append(rule)
         virtual_service["spec"]["http"] = vs_http_rule_new
-        k8s_custom_object.patch_namespaced_custom_object(
+        await k8s_custom_object.patch_namespaced_custom_object(
             group, version, namespace, plural, vs_name, body=virtual_service
         )
         operation_end_time = datetime.datetime.now()
@@ -298,7 +513,7 @@ def migrate_fn(spec, name, meta, old, new, logger, **_):
 
         # wait for the time window
         mirror_time = spec.get("mirrorTime")
-        time.sleep(mirror_time)
+        await asyncio.sleep(mirror_time)
 
         operation_end_time = datetime.datetime.now()
         timestamps.append([operation_name, operation_start_time, operation_end_time])
@@ -308,8 +523,10 @@ def migrate_fn(spec, name, meta, old, new, logger, **_):
 
         # update virtualservice so it does not mirror
         # change destination host to new deployment service
-        virtual_service = k8s_custom_object.list_namespaced_custom_object(
-            group, version, namespace, plural, label_selector=label_selector
+        virtual_service = (
+            await k8s_custom_object.list_namespaced_custom_object(
+                group, version, namespace, plural, label_selector=label_selector
+            )
         ).get("items")[0]
         vs_http_rule_new = []
         for rule in vs_http_rule:
@@ -321,7 +538,7 @@ def migrate_fn(spec, name, meta, old, new, logger, **_):
 
             vs_http_rule_new.append(rule)
         virtual_service["spec"]["http"] = vs_http_rule_new
-        k8s_custom_object.patch_namespaced_custom_object(
+        await k8s_custom_object.patch_namespaced_custom_object(
             group, version, namespace, plural, vs_name, body=virtual_service
         )
 
@@ -335,16 +552,97 @@ def migrate_fn(spec, name, meta, old, new, logger, **_):
         for deployment in deployments:
             if current_deployment_affinity == deployment.get("affinity"):
                 configs = deployment.get("configs")
-                for config in configs:
-                    delete_from_dict(k8s_client, config)
+                try:
+                    await delete_from_dicts(k8s_client, configs)
+                except FailToDeleteError:
+                    logger.exception("Exception deleting old objects.")
 
-        ensure_pod_termination(
+        terminated = await ensure_pod_termination(
             k8s_core_v1, current_deployment_app_name, namespace, logger
         )
 
         operation_end_time = datetime.datetime.now()
         timestamps.append([operation_name, operation_start_time, operation_end_time])
 
+        auto_migration_entry(meta.get("namespace"), name)[
+            "last_migration"
+        ] = time.monotonic()
         generate_chart(timestamps)
 
+        # the twin is on the target, but a standby can not replace pods still running
+        if not terminated:
+            logger.error("Warm pool not refilled, the source pods are still running.")
+            return
+
+        # refill the warm pool, off the critical path
+        if spec.get("warmPool"):
+            await create_standby_instances(
+                k8s_client, spec, name, [current_deployment_affinity], logger
+            )
+
+        return
+
+
+@kopf.timer(
+    "cyberphysicalapplications",
+    interval=auto_migration_interval,
+    when=lambda spec, **_: (spec.get("autoMigration") or {}).get("enabled", False),
+)
+async def auto_migrate_fn(spec, name, logger, meta, namespace, **kwargs):
+    parameters = spec.get("autoMigration")
+    threshold = (spec.get("requirements") or {}).get("odte")
+    if threshold is None:
+        return
+
+    state = auto_migration_entry(namespace, name)
+    deployments = spec.get("deployments")
+
+    current_deployment_affinity = (meta.get("annotations") or {}).get(
+        "child-deployment-affinity"
+    )
+    current_deployment = None
+    for deployment in deployments:
+        if deployment.get("affinity") == current_deployment_affinity:
+            current_deployment = deployment
+    if current_deployment is None:
+        return
+
+    try:
+        odte = await asyncio.to_thread(measure_odte, spec, current_deployment, logger)
+    except Exception:
+        return
+
+    # violating below the requirement, back to normal only above requirement + hysteresis
+    if odte < threshold:
+        state["violating"] = True
+    elif odte >= threshold + parameters.get("hysteresis", 0.05):
+        state["violating"] = False
+    state["violations"] = state["violations"] + 1 if state["violating"] else 0
+
+    if state["violations"] < parameters.get("violations", 3):
         return
+
+    last_migration = state["last_migration"]
+    if (
+        last_migration is not None
+        and time.monotonic() - last_migration < parameters.get("cooldown", 300)
+    ):
+        logger.info(f"ODTE {odte} violates the requirement {threshold}, migration in cooldown.")
+        return
+
+    lock = migration_locks.get(f"{namespace}/{name}")
+    if lock is not None and lock.locked():
+        return
+
+    logger.info(f"ODTE {odte} violates the requirement {threshold}, migrating.")
+    state["violating"] = False
+    state["violations"] = 0
+    await migrate_fn(
+        spec=spec,
+        name=name,
+        old=False,
+        new=True,
+        logger=logger,
+        meta=meta,
+        namespace=namespace,
+    )
@@ -0,0 +1,232 @@
+import logging
+import random
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from kubernetes import client
+from kubernetes.utils import parse_quantity
+
+# nodes of an affinity carry this label, the same used in the nodeSelector
+ZONE_LABEL = "zone"
+
+
+def probe_rtt(url, timeout=5):
+    """Round trip time towards a zone, TCP connect for tcp:// and mqtt://, GET otherwise."""
+
+    parsed = urlparse(url)
+    start = time.monotonic()
+    if parsed.scheme in ("tcp", "mqtt"):
+        with socket.create_connection(
+            (parsed.hostname, parsed.port or 1883), timeout=timeout
+        ):
+            pass
+    else:
+        requests.get(url, timeout=timeout)
+    return time.monotonic() - start
+
+
+def latency_score(affinity, snapshot):
+    latencies = snapshot["latencies"]
+    if affinity not in latencies:
+        return None
+
+    best = min(latencies.values())
+    if latencies[affinity] == float("inf"):
+        return 0.0
+    if best <= 0:
+        return 1.0
+    return best / latencies[affinity]
+
+
+def headroom_score(affinity, snapshot):
+    headroom = snapshot["headroom"].get(affinity)
+    if headroom is None:
+        return None
+    return max(0.0, min(headroom["cpu"], headroom["memory"]))
+
+
+def load_score(affinity, snapshot):
+    # no count before the first refresh
+    if snapshot["twins"] is None:
+        return None
+    return 1 / (1 + snapshot["twins"].get(affinity, 0))
+
+
+class PlacementEngine:
+    """Scores the candidate deployments of a migration.
+
+    The inputs (latency towards the zones, CPU and memory headroom of the
+    nodes, twins already hosted) are collected by a background thread, so
+    choosing a deployment only reads the last snapshot.
+    """
+
+    def __init__(self, refresh_interval=30, latency_smoothing=0.3):
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._refresh_interval = refresh_interval
+        self._latency_smoothing = latency_smoothing
+        self._snapshot = {"latencies": {}, "headroom": {}, "twins": None}
+        self._logger = logging.getLogger(__name__)
+        # name -> (scorer, weight), a scorer returns a value in [0, 1] or
+        # None when it has no data for the affinity
+        self._scorers = {}
+
+    def add_scorer(self, name, scorer, weight=1.0):
+        with self._lock:
+            self._scorers[name] = (scorer, weight)
+
+    def remove_scorer(self, name):
+        with self._lock:
+            self._scorers.pop(name, None)
+
+    @property
+    def snapshot(self):
+        with self._lock:
+            return self._snapshot
+
+    def start(self, logger=None):
+        if self._thread is not None:
+            return
+        if logger is not None:
+            self._logger = logger
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._refresh_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                self._logger.warning(f"Placement refresh failed. {e}")
+            self._stop.wait(self._refresh_interval)
+
+    def refresh(self):
+        cpas = client.CustomObjectsApi().list_cluster_custom_object(
+            "test.dev", "v1", "cyberphysicalapplications"
+        )
+
+        # twins hosted by each zone and the probe urls of the zones
+        twins = {}
+        probe_urls = {}
+        for cpa in cpas.get("items", []):
+            annotations = cpa.get("metadata").get("annotations") or {}
+            affinity = annotations.get("child-deployment-affinity")
+            if affinity is not None:
+                twins[affinity] = twins.get(affinity, 0) + 1
+
+            for deployment in cpa.get("spec").get("deployments") or []:
+                if deployment.get("probeUrl"):
+                    probe_urls.setdefault(
+                        deployment.get("affinity"), deployment.get("probeUrl")
+                    )
+
+        latencies = dict(self.snapshot["latencies"])
+        for affinity, url in probe_urls.items():
+            try:
+                latency = probe_rtt(url)
+            except (OSError, requests.RequestException):
+                latency = float("inf")
+
+            previous = latencies.get(affinity)
+            if previous is None or float("inf") in (previous, latency):
+                latencies[affinity] = latency
+            else:
+                latencies[affinity] = (
+                    self._latency_smoothing * latency
+                    + (1 - self._latency_smoothing) * previous
+                )
+
+        snapshot = {
+            "latencies": latencies,
+            "headroom": self.collect_headroom(),
+            "twins": twins,
+        }
+        with self._lock:
+            self._snapshot = snapshot
+
+    def collect_headroom(self):
+        # free fraction of cpu and memory of the nodes of each zone
+        nodes = client.CoreV1Api().list_node(label_selector=ZONE_LABEL)
+        try:
+            metrics = client.CustomObjectsApi().list_cluster_custom_object(
+                "metrics.k8s.io", "v1beta1", "nodes"
+            )
+        except client.ApiException:
+            # no metrics-server
+            return {}
+        usage = {item["metadata"]["name"]: item["usage"] for item in metrics["items"]}
+
+        totals = {}
+        for node in nodes.items:
+            if node.metadata.name not in usage:
+                continue
+            affinity = node.metadata.labels.get(ZONE_LABEL)
+            total = totals.setdefault(
+                affinity, {"cpu": 0, "memory": 0, "cpu_used": 0, "memory_used": 0}
+            )
+            for resource in ("cpu", "memory"):
+                total[resource] += parse_quantity(node.status.allocatable[resource])
+                total[f"{resource}_used"] += parse_quantity(
+                    usage[node.metadata.name][resource]
+                )
+
+        headroom = {}
+        for affinity, total in totals.items():
+            headroom[affinity] = {
+                resource: float(1 - total[f"{resource}_used"] / total[resource])
+                if total[resource] > 0
+                else 0.0
+                for resource in ("cpu", "memory")
+            }
+        return headroom
+
+    def score(self, affinity):
+        with self._lock:
+            snapshot = self._snapshot
+            scorers = list(self._scorers.values())
+
+        # weighted mean of the scorers with data for the affinity
+        total = 0.0
+        weights = 0.0
+        for scorer, weight in scorers:
+            value = scorer(affinity, snapshot)
+            if value is None:
+                continue
+            total += weight * value
+            weights += weight
+
+        if weights == 0:
+            return None
+        return total / weights
+
+    def choose(self, deployments, current_affinity):
+        candidates = [
+            d for d in deployments if d.get("affinity") != current_affinity
+        ]
+        if not candidates:
+            return None
+
+        scores = [(self.score(d.get("affinity")), d) for d in candidates]
+        scored = [(s, d) for s, d in scores if s is not None]
+        if not scored:
+            return random.choice(candidates)
+
+        best = max(s for s, _ in scored)
+        return random.choice([d for s, d in scored if s == best])
+
+
+def default_engine(refresh_interval=30):
+    engine = PlacementEngine(refresh_interval=refresh_interval)
+    engine.add_scorer("latency", latency_score, 0.5)
+    engine.add_scorer("headroom", headroom_score, 0.3)
+    engine.add_scorer("load", load_score, 0.2)
+    return engine
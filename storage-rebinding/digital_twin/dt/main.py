@@ -1,4 +1,4 @@
-from flask import Flask, request
+from flask import Flask, Response, request
 from enum import Enum
 import signal
 import time
@@ -6,8 +6,23 @@ import threading
 import json
 import os
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import logging
 import collections
+import bisect
+import queue
+import array
+import math
+import zlib
+import struct
+import mmap
+import sys
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 # Global vars
 # logging
@@ -25,6 +40,16 @@ if mqtt_broker is None or mqtt_port is None or mqtt_topic is None:
 
 # ODTE
 odte_threshold = float(os.environ.get("ODTE_THRESHOLD", 0.6))
+odte_window_length_sec = float(os.environ.get("ODTE_WINDOW_LENGTH", 10))
+odte_desired_timeliness_sec = float(os.environ.get("ODTE_DESIRED_TIMELINESS", 0.5))
+# messages per second, can be fractional or above 1
+odte_expected_msg_sec = float(os.environ.get("ODTE_EXPECTED_MSG_RATE", 1))
+# extra windows (seconds) evaluated along the main one, e.g. "1,60"
+odte_windows = [
+    float(window)
+    for window in os.environ.get("ODTE_WINDOWS", "").split(",")
+    if window.strip() != ""
+]
 
 # Application
 app = Flask(__name__)
@@ -32,11 +57,30 @@ average_threshold = float(os.environ.get("AVERAGE_THRESHOLD", 55.0))
 observations_deque_length = int(os.environ.get("OBSERVATIONS_DEQUE_LENGTH", 100))
 messages_deque_length = int(os.environ.get("MESSAGES_DEQUE_LENGTH", 100))
 no_sensors = int(os.environ.get("NO_SENSORS", 100))
+# "objects" keeps one VirtualSensor per sensor, "columnar" stores them in arrays
+sensor_store = os.environ.get("SENSOR_STORE", "objects")
+# keep whole decoded payloads in the message log (debugging only, state grows a lot)
+retain_payloads = os.environ.get("RETAIN_PAYLOADS", "false").lower() == "true"
 physical_twin_name = "rotating_machine_1"
+# persistent MQTT 5 session shared by the instances of the twin, the broker
+# keeps the QoS 1 messages of the migration gap for the next instance
+mqtt_persistent_session = (
+    os.environ.get("MQTT_PERSISTENT_SESSION", "true").lower() == "true"
+)
+# set per CPA by the operator, the default only fits a single twin on the broker
+mqtt_client_id = os.environ.get("MQTT_CLIENT_ID", f"dt-{physical_twin_name}")
+mqtt_session_expiry = int(os.environ.get("MQTT_SESSION_EXPIRY", 3600))
+mqtt_qos = int(os.environ.get("MQTT_QOS", 1))
+# messages in flight, higher catches up faster on the replayed ones
+mqtt_max_inflight = int(os.environ.get("MQTT_MAX_INFLIGHT", 100))
 dump_path_file = os.environ.get("DUMP_PATH_FILE")
 if dump_path_file is None:
     logger.error("DUMP_PATH_FILE is not set.")
     exit(1)
+# the changes are appended to a log next to the snapshot, flushed every interval
+# and compacted into a new snapshot once the log grows over the size
+dump_flush_interval = float(os.environ.get("DUMP_FLUSH_INTERVAL", 1.0))
+dump_log_max_bytes = int(os.environ.get("DUMP_LOG_MAX_BYTES", 16 * 1024 * 1024))
 
 # Measurements
 exec_measurements = collections.deque(maxlen=messages_deque_length)
@@ -71,6 +115,149 @@ signal.signal(signal.SIGINT, graceful_shutdown)
 signal.signal(signal.SIGTERM, graceful_shutdown)
 
 
+def layout_id(sensor_names):
+    # stable identifier of a sensor ordering, shared by the physical and digital twin
+    return zlib.crc32("\n".join(sensor_names).encode("utf-8"))
+
+
+class JsonCodec:
+    name = "json"
+    content_type = "application/json"
+
+    def encode(self, message):
+        return json.dumps(message).encode("utf-8")
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    content_type = "application/msgpack"
+
+    def encode(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+class PackedCodec:
+    # little-endian header: version, flags, reserved, layout id, seq, timestamp, no. of values
+    HEADER = struct.Struct("<BBHIIdI")
+    # version 1 frames had no sequence number
+    HEADER_V1 = struct.Struct("<BBHIdI")
+    NAMES_LENGTH = struct.Struct("<I")
+    VERSION = 2
+    FLAG_LAYOUT = 0x01
+    FLAG_DELTA = 0x02
+
+    name = "packed"
+    content_type = "application/vnd.dt.packed"
+
+    def encode(self, message):
+        if "values" not in message:
+            raise ValueError("Packed codec only encodes positional messages.")
+
+        values = message["values"]
+        flags = self.FLAG_LAYOUT if "sensors" in message else 0
+        if message.get("delta", False):
+            flags |= self.FLAG_DELTA
+        payload = bytearray(
+            self.HEADER.pack(
+                self.VERSION,
+                flags,
+                0,
+                message["layout"],
+                message.get("seq", 0),
+                message["timestamp"],
+                len(values),
+            )
+        )
+
+        packed_values = array.array(
+            "d", [math.nan if value is None else value for value in values]
+        )
+        if sys.byteorder == "big":
+            packed_values.byteswap()
+        payload += packed_values.tobytes()
+
+        if flags & self.FLAG_DELTA:
+            packed_indices = array.array("I", message["indices"])
+            if sys.byteorder == "big":
+                packed_indices.byteswap()
+            payload += packed_indices.tobytes()
+
+        if flags & self.FLAG_LAYOUT:
+            names = "\n".join(message["sensors"]).encode("utf-8")
+            payload += self.NAMES_LENGTH.pack(len(names)) + names
+
+        return bytes(payload)
+
+    def decode(self, payload):
+        version = payload[0]
+        if version == self.VERSION:
+            _, flags, _, layout, seq, timestamp, count = self.HEADER.unpack_from(
+                payload
+            )
+            offset = self.HEADER.size
+        elif version == 1:
+            _, flags, _, layout, timestamp, count = self.HEADER_V1.unpack_from(payload)
+            seq = None
+            offset = self.HEADER_V1.size
+        else:
+            raise ValueError(f"Unsupported packed payload version {version}.")
+
+        values = array.array("d")
+        values.frombytes(payload[offset : offset + 8 * count])
+        if sys.byteorder == "big":
+            values.byteswap()
+        offset += 8 * count
+
+        message = {
+            "layout": layout,
+            "values": [None if value != value else value for value in values.tolist()],
+            "timestamp": timestamp,
+        }
+        if seq is not None:
+            message["seq"] = seq
+
+        if flags & self.FLAG_DELTA:
+            indices = array.array("I")
+            indices.frombytes(payload[offset : offset + indices.itemsize * count])
+            if sys.byteorder == "big":
+                indices.byteswap()
+            offset += indices.itemsize * count
+            message["indices"] = indices.tolist()
+            message["delta"] = True
+
+        if flags & self.FLAG_LAYOUT:
+            (names_length,) = self.NAMES_LENGTH.unpack_from(payload, offset)
+            offset += self.NAMES_LENGTH.size
+            names = bytes(payload[offset : offset + names_length]).decode("utf-8")
+            message["sensors"] = names.split("\n")
+
+        return message
+
+
+codecs = {"json": JsonCodec(), "packed": PackedCodec()}
+if msgpack is not None:
+    codecs["msgpack"] = MsgpackCodec()
+
+
+def codec_for_topic(topic):
+    # non-JSON payloads are published on "<topic>/<machine>/<codec>"
+    return codecs.get(topic.rsplit("/", 1)[-1], codecs["json"])
+
+
+def codec_for_content_type(content_type):
+    mimetype = (content_type or "").split(";", 1)[0].strip()
+    for codec in codecs.values():
+        if codec.content_type == mimetype:
+            return codec
+    return codecs["json"]
+
+
 class VirtualSensorState(Enum):
     WORKING = 0
     STOPPED = 1
@@ -135,10 +322,256 @@ class VirtualSensor:
         }
 
 
+class VirtualSensorView:
+    def __init__(self, store, index):
+        self._store = store
+        self._index = index
+
+    @property
+    def name(self):
+        return self._store.name_at(self._index)
+
+    @property
+    def state(self):
+        return self._store.state_at(self._index)
+
+    @state.setter
+    def state(self, state):
+        self._store.set_state_at(self._index, state)
+
+    @property
+    def value(self):
+        return self._store.value_at(self._index)
+
+    @value.setter
+    def value(self, value):
+        self._store.set_value_at(self._index, value)
+
+    @property
+    def measuring_unit(self):
+        return self._store.measuring_unit_at(self._index)
+
+    @property
+    def sampling_rate(self):
+        return self._store.sampling_rate_at(self._index)
+
+    def to_json(self):
+        return {
+            "name": self.name,
+            "state": self.state.name,
+            "value": self.value,
+            "measuring_unit": self.measuring_unit,
+            "sampling_rate": self.sampling_rate,
+        }
+
+
+class ColumnarSensorStore:
+    # missing readings are stored as NaN in the values column
+    _STATE_NAMES = [state.name for state in VirtualSensorState]
+
+    def __init__(
+        self,
+        names=[],
+        states=None,
+        values=None,
+        measuring_units=None,
+        sampling_rates=None,
+    ):
+        count = len(names)
+        self._names = list(names)
+        self._index = {name: i for i, name in enumerate(self._names)}
+        self._states = array.array(
+            "b",
+            (
+                [VirtualSensorState[state].value for state in states]
+                if states is not None
+                else [VirtualSensorState.STOPPED.value] * count
+            ),
+        )
+        self._values = array.array(
+            "d",
+            (
+                [math.nan if value is None else value for value in values]
+                if values is not None
+                else [math.nan] * count
+            ),
+        )
+        self._measuring_units = (
+            list(measuring_units) if measuring_units is not None else ["[s]"] * count
+        )
+        self._sampling_rates = array.array(
+            "d", sampling_rates if sampling_rates is not None else [1] * count
+        )
+
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_sensors(cls, sensors_list):
+        return cls(
+            [sensor.name for sensor in sensors_list],
+            [sensor.state.name for sensor in sensors_list],
+            [sensor.value for sensor in sensors_list],
+            [sensor.measuring_unit for sensor in sensors_list],
+            [sensor.sampling_rate for sensor in sensors_list],
+        )
+
+    def __getitem__(self, name):
+        return VirtualSensorView(self, self._index[name])
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def keys(self):
+        return list(self._names)
+
+    def values(self):
+        return [VirtualSensorView(self, i) for i in range(len(self._names))]
+
+    def items(self):
+        return [
+            (name, VirtualSensorView(self, i)) for i, name in enumerate(self._names)
+        ]
+
+    def get(self, name, default=None):
+        index = self._index.get(name)
+        if index is None:
+            return default
+        return VirtualSensorView(self, index)
+
+    def name_at(self, index):
+        return self._names[index]
+
+    def state_at(self, index):
+        with self._lock:
+            return VirtualSensorState(self._states[index])
+
+    def set_state_at(self, index, state):
+        with self._lock:
+            self._states[index] = state.value
+
+    def value_at(self, index):
+        with self._lock:
+            value = self._values[index]
+        return None if math.isnan(value) else value
+
+    def set_value_at(self, index, value):
+        with self._lock:
+            self._values[index] = math.nan if value is None else value
+
+    def measuring_unit_at(self, index):
+        return self._measuring_units[index]
+
+    def sampling_rate_at(self, index):
+        return self._sampling_rates[index]
+
+    def index_of(self, name):
+        return self._index.get(name)
+
+    def apply_readings(self, readings):
+        return self.apply_indexed(
+            [self._index.get(read["sensor"]) for read in readings],
+            [read["value"] for read in readings],
+        )
+
+    def apply_indexed(self, indices, new_values):
+        changed = set()
+
+        with self._lock:
+            values = self._values
+            for index, value in zip(indices, new_values):
+                if index is None:
+                    continue
+
+                if value is None:
+                    if not math.isnan(values[index]):
+                        values[index] = math.nan
+                        changed.add(self._names[index])
+                elif values[index] != value:
+                    values[index] = value
+                    changed.add(self._names[index])
+
+        return changed
+
+    def to_columns(self):
+        with self._lock:
+            states = self._states.tolist()
+            values = self._values.tolist()
+            sampling_rates = self._sampling_rates.tolist()
+
+        return {
+            "names": list(self._names),
+            "states": [self._STATE_NAMES[state] for state in states],
+            "values": [None if value != value else value for value in values],
+            "measuring_units": list(self._measuring_units),
+            "sampling_rates": sampling_rates,
+        }
+
+
 class VirtualRotatingMachine:
-    def __init__(self, name="rotating_machine", sensors_list=[]):
+    def __init__(self, name="rotating_machine", sensors_list=[], columnar=None):
+        global sensor_store
+        if columnar is None:
+            columnar = sensor_store == "columnar"
+
         self._name = name
-        self._sensors = {sensor.name: sensor for sensor in sensors_list}
+        self._columnar = columnar
+        self._lock = threading.Lock()
+        if columnar:
+            self._sensors = ColumnarSensorStore.from_sensors(sensors_list)
+        else:
+            self._sensors = {sensor.name: sensor for sensor in sensors_list}
+        self._bind_own_layout()
+
+    @classmethod
+    def from_json(cls, data):
+        global sensor_store
+        machine = cls(data["name"], columnar=False)
+
+        # accept both the per-sensor and the columnar dump layouts
+        if "columns" in data:
+            columns = data["columns"]
+            if sensor_store == "columnar":
+                machine._columnar = True
+                machine._sensors = ColumnarSensorStore(
+                    columns["names"],
+                    columns["states"],
+                    columns["values"],
+                    columns["measuring_units"],
+                    columns["sampling_rates"],
+                )
+            else:
+                machine._sensors = {
+                    name: VirtualSensor(
+                        name, sampling_rate, measuring_unit, VirtualSensorState[state], value
+                    )
+                    for name, state, value, measuring_unit, sampling_rate in zip(
+                        columns["names"],
+                        columns["states"],
+                        columns["values"],
+                        columns["measuring_units"],
+                        columns["sampling_rates"],
+                    )
+                }
+            machine._bind_own_layout()
+            return machine
+
+        sensors_list = [
+            VirtualSensor(
+                sensor["name"],
+                sensor["sampling_rate"],
+                sensor["measuring_unit"],
+                VirtualSensorState[sensor["state"]],
+                sensor["value"],
+            )
+            for sensor in data["sensors"]
+        ]
+        return cls(data["name"], sensors_list)
 
     @property
     def name(self):
@@ -148,11 +581,600 @@ class VirtualRotatingMachine:
     def sensors(self):
         return self._sensors
 
+    @property
+    def columnar(self):
+        return self._columnar
+
+    def _bind_own_layout(self):
+        # a physical twin with the same sensor ordering can skip the announcement
+        names = list(self._sensors)
+        self._layouts = {}
+        self.bind_layout(layout_id(names), names)
+
+    def has_layout(self, layout):
+        with self._lock:
+            return layout in self._layouts
+
+    def bind_layout(self, layout, names):
+        if self._columnar:
+            compiled = [self._sensors.index_of(name) for name in names]
+        else:
+            compiled = [self._sensors.get(name) for name in names]
+
+        with self._lock:
+            self._layouts[layout] = compiled
+
+    def apply_readings(self, readings):
+        if self._columnar:
+            return self._sensors.apply_readings(readings)
+
+        return self._apply_to_sensors(
+            [self._sensors.get(read["sensor"]) for read in readings],
+            [read["value"] for read in readings],
+        )
+
+    def apply_values(self, layout, values, indices=None):
+        with self._lock:
+            compiled = self._layouts.get(layout)
+        if compiled is None:
+            return None
+
+        # deltas only carry the positions that changed
+        if indices is not None:
+            compiled = [compiled[i] for i in indices]
+
+        if self._columnar:
+            return self._sensors.apply_indexed(compiled, values)
+
+        return self._apply_to_sensors(compiled, values)
+
+    def _apply_to_sensors(self, sensors, values):
+        changed = set()
+        with self._lock:
+            for sensor, value in zip(sensors, values):
+                if sensor is None:
+                    continue
+
+                # the machine lock keeps the message whole for to_json, the
+                # sensor lock for the readers of a single sensor
+                with sensor._lock:
+                    if sensor._reading == value:
+                        continue
+                    sensor._reading = value
+                changed.add(sensor.name)
+
+        return changed
+
     def to_json(self):
-        return {
-            "name": self.name,
-            "sensors": [sensor.to_json() for sensor in self.sensors.values()],
+        if self._columnar:
+            return {"name": self.name, "columns": self._sensors.to_columns()}
+
+        # not between two sensors of a message being applied
+        with self._lock:
+            sensors = [sensor.to_json() for sensor in self.sensors.values()]
+        return {"name": self.name, "sensors": sensors}
+
+
+class WindowedAggregate:
+    def __init__(self, values=(), maxlen=None):
+        self._maxlen = maxlen
+        self._values = collections.deque()
+        # sequence number of the next appended value
+        self._seq = 0
+        self._sum = 0.0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._evictions = 0
+        # monotonic (seq, value) candidates for the sliding min / max
+        self._min_candidates = collections.deque()
+        self._max_candidates = collections.deque()
+
+        for value in values:
+            self.append(value)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    @property
+    def maxlen(self):
+        return self._maxlen
+
+    @property
+    def count(self):
+        return len(self._values)
+
+    @property
+    def total(self):
+        return self._sum
+
+    @property
+    def mean(self):
+        if len(self._values) == 0:
+            return 0.0
+        return self._sum / len(self._values)
+
+    @property
+    def variance(self):
+        if len(self._values) == 0:
+            return 0.0
+        return max(self._m2, 0.0) / len(self._values)
+
+    @property
+    def min(self):
+        if len(self._min_candidates) == 0:
+            return None
+        return self._min_candidates[0][1]
+
+    @property
+    def max(self):
+        if len(self._max_candidates) == 0:
+            return None
+        return self._max_candidates[0][1]
+
+    def append(self, value):
+        # readings not yet sampled by the physical twin carry no value
+        if value is None:
+            return
+
+        if self._maxlen is not None and len(self._values) == self._maxlen:
+            self._evict()
+
+        seq = self._seq
+        self._seq += 1
+        self._values.append(value)
+
+        self._sum += value
+        delta = value - self._mean
+        self._mean += delta / len(self._values)
+        self._m2 += delta * (value - self._mean)
+
+        while self._min_candidates and self._min_candidates[-1][1] >= value:
+            self._min_candidates.pop()
+        self._min_candidates.append((seq, value))
+        while self._max_candidates and self._max_candidates[-1][1] <= value:
+            self._max_candidates.pop()
+        self._max_candidates.append((seq, value))
+
+    def _evict(self):
+        evicted_seq = self._seq - len(self._values)
+        value = self._values.popleft()
+
+        if len(self._values) == 0:
+            self._sum = 0.0
+            self._mean = 0.0
+            self._m2 = 0.0
+        else:
+            self._sum -= value
+            delta = value - self._mean
+            self._mean -= delta / len(self._values)
+            self._m2 -= delta * (value - self._mean)
+
+        if self._min_candidates[0][0] == evicted_seq:
+            self._min_candidates.popleft()
+        if self._max_candidates[0][0] == evicted_seq:
+            self._max_candidates.popleft()
+
+        # resync once per window to keep the rounding drift bounded
+        self._evictions += 1
+        if self._evictions >= len(self._values):
+            self._resync()
+
+    def _resync(self):
+        self._evictions = 0
+        if len(self._values) == 0:
+            return
+        self._sum = sum(self._values)
+        self._mean = self._sum / len(self._values)
+        self._m2 = sum((value - self._mean) ** 2 for value in self._values)
+
+
+class TimeIndexedRing:
+    def __init__(self, values=(), maxlen=100, keep_sorted=False):
+        self._maxlen = maxlen
+        self._times = array.array("d", [0.0] * maxlen)
+        self._values = array.array("d", [0.0] * maxlen)
+        self._start = 0
+        self._size = 0
+        # total no. of appended entries, used as an absolute position
+        self._appended = 0
+        # absolute positions whose time is lower than the previous entry's
+        self._inversions = collections.deque()
+        self._sorted_values = [] if keep_sorted else None
+
+        self._lock = threading.Lock()
+
+        for value in values:
+            if isinstance(value, (list, tuple)):
+                # (value, time) pair
+                self.append(*value)
+            else:
+                # value only, from an older dump
+                self.append(value)
+
+    def __len__(self):
+        with self._lock:
+            return self._size
+
+    def __iter__(self):
+        return iter(self.values())
+
+    @property
+    def maxlen(self):
+        return self._maxlen
+
+    def append(self, value, timestamp=0.0):
+        with self._lock:
+            if self._size == self._maxlen:
+                self._evict()
+
+            if self._size > 0 and timestamp < self._time_at(self._size - 1):
+                self._inversions.append(self._appended)
+
+            position = (self._start + self._size) % self._maxlen
+            self._times[position] = timestamp
+            self._values[position] = value
+            self._size += 1
+            self._appended += 1
+
+            if self._sorted_values is not None:
+                bisect.insort(self._sorted_values, value)
+
+    def _evict(self):
+        evicted = self._appended - self._size
+        value = self._values[self._start]
+        self._start = (self._start + 1) % self._maxlen
+        self._size -= 1
+
+        # the pair (evicted, evicted + 1) is no longer inside the ring
+        while self._inversions and self._inversions[0] <= evicted + 1:
+            self._inversions.popleft()
+
+        if self._sorted_values is not None:
+            del self._sorted_values[bisect.bisect_left(self._sorted_values, value)]
+
+    def _time_at(self, index):
+        return self._times[(self._start + index) % self._maxlen]
+
+    def _value_at(self, index):
+        return self._values[(self._start + index) % self._maxlen]
+
+    def _item_at(self, index):
+        return [self._value_at(index), self._time_at(index)]
+
+    def values(self):
+        with self._lock:
+            return [self._value_at(i) for i in range(self._size)]
+
+    def times(self):
+        with self._lock:
+            return [self._time_at(i) for i in range(self._size)]
+
+    def items(self):
+        # (value, time) pairs, what a dump needs to rebuild the ring
+        with self._lock:
+            return [self._item_at(i) for i in range(self._size)]
+
+    def _range_between(self, start_time, end_time, lo):
+        first_absolute = self._appended - self._size + lo
+        if self._inversions and self._inversions[-1] > first_absolute:
+            # out of order arrivals in range, fall back to a scan
+            return [
+                i
+                for i in range(lo, self._size)
+                if start_time <= self._time_at(i) <= end_time
+            ]
+
+        positions = range(self._size)
+        first = bisect.bisect_left(positions, start_time, lo=lo, key=self._time_at)
+        last = bisect.bisect_right(positions, end_time, lo=first, key=self._time_at)
+        return range(first, last)
+
+    def first_time_between(self, start_time, end_time):
+        with self._lock:
+            positions = self._range_between(start_time, end_time, 0)
+            if len(positions) == 0:
+                return None
+            if isinstance(positions, range):
+                return self._time_at(positions.start)
+            return min(self._time_at(i) for i in positions)
+
+    def count_between(self, start_time, end_time, last=None):
+        with self._lock:
+            lo = 0 if last is None else max(0, self._size - int(last))
+            return len(self._range_between(start_time, end_time, lo))
+
+    def values_between(self, start_time, end_time):
+        with self._lock:
+            return [
+                self._value_at(i)
+                for i in self._range_between(start_time, end_time, 0)
+            ]
+
+    def count_at_most_between(self, start_time, end_time, threshold):
+        with self._lock:
+            positions = self._range_between(start_time, end_time, 0)
+            at_most = sum(1 for i in positions if self._value_at(i) <= threshold)
+            return len(positions), at_most
+
+    def count_at_most(self, threshold):
+        with self._lock:
+            if self._sorted_values is not None:
+                return bisect.bisect_right(self._sorted_values, threshold)
+            return sum(
+                1 for i in range(self._size) if self._value_at(i) <= threshold
+            )
+
+
+class MessageLog:
+    def __init__(self, entries=(), maxlen=100, retain_payloads=False):
+        self._maxlen = maxlen
+        self._retain_payloads = retain_payloads
+        self._entries = collections.deque(maxlen=maxlen)
+        # sender timestamps (with arrival times as values) for reliability
+        self._times = TimeIndexedRing(maxlen=maxlen)
+        self._next_seq = 0
+
+        self._lock = threading.Lock()
+
+        for entry in entries:
+            if "readings" in entry or "values" in entry:
+                # full payload from an older dump
+                self.append(entry, entry.get("received", 0.0))
+            else:
+                self._append_entry(dict(entry))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._entries))
+
+    @property
+    def maxlen(self):
+        return self._maxlen
+
+    @property
+    def last_seq(self):
+        with self._lock:
+            return self._next_seq - 1
+
+    def extend(self, entries):
+        for entry in entries:
+            if "readings" in entry or "values" in entry:
+                # full payload from an older dump
+                self.append(entry, entry.get("received", 0.0))
+            else:
+                self._append_entry(dict(entry))
+
+    def is_duplicate(self, data):
+        # redelivered or replayed message already in the log, a physical twin
+        # restarting its numbering sends newer timestamps
+        seq = data.get("seq")
+        if seq is None:
+            return False
+
+        with self._lock:
+            if len(self._entries) == 0:
+                return False
+            return (
+                seq < self._next_seq
+                and data["timestamp"] <= self._entries[-1]["timestamp"]
+            )
+
+    def append(self, data, received, size=0):
+        entry = {
+            "timestamp": data["timestamp"],
+            "received": received,
+            "seq": data.get("seq"),
+            "size": size,
         }
+        if self._retain_payloads:
+            entry["payload"] = data
+
+        return self._append_entry(entry)
+
+    def _append_entry(self, entry):
+        with self._lock:
+            # physical twins that do not number their messages get a local seq
+            if entry.get("seq") is None:
+                entry["seq"] = self._next_seq
+            self._next_seq = entry["seq"] + 1
+
+            self._entries.append(entry)
+            self._times.append(entry.get("received", 0.0), entry["timestamp"])
+
+        return entry
+
+    def count_between(self, start_time, end_time, last=None):
+        return self._times.count_between(start_time, end_time, last)
+
+    def next_expiry(self, window_length_sec):
+        # seconds until the oldest message in the window falls out of it
+        now = time.time()
+        oldest = self._times.first_time_between(now - window_length_sec, now)
+        if oldest is None:
+            return None
+        return max(oldest + window_length_sec - now, 0.0) + 0.001
+
+
+class DamagedDumpError(Exception):
+    """A dump whose snapshot and log do not make up a whole state."""
+
+
+class StateDump:
+    # snapshot: magic, body length, crc32 of the body, last log record in it
+    SNAPSHOT_HEADER = struct.Struct("<4sQIQ")
+    SNAPSHOT_MAGIC = b"DTS1"
+    # log record: payload length, crc32 of the payload, record seq
+    RECORD_HEADER = struct.Struct("<IIQ")
+
+    def __init__(self, path):
+        self._path = path
+        self._tmp_path = f"{path}.tmp"
+        self._log_path = f"{path}.log"
+        # previous log, removed once a snapshot covers it
+        self._old_log_path = f"{path}.log.1"
+        self._log = None
+        self._seq = 0
+
+        self._lock = threading.Lock()
+
+    def exists(self):
+        return any(
+            os.path.isfile(path)
+            for path in (self._path, self._log_path, self._old_log_path)
+        )
+
+    def clear(self):
+        # drops the snapshot and the logs, the next records start a new dump
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+            for path in (self._path, self._tmp_path, self._log_path, self._old_log_path):
+                if os.path.isfile(path):
+                    os.remove(path)
+            self._seq = 0
+
+    @property
+    def log_size(self):
+        with self._lock:
+            if self._log is None:
+                return 0
+            return self._log.tell()
+
+    def append(self, record):
+        payload = json.dumps(record).encode("utf-8")
+        with self._lock:
+            if self._log is None:
+                self._log = open(self._log_path, "ab")
+            self._seq += 1
+            self._log.write(
+                self.RECORD_HEADER.pack(len(payload), zlib.crc32(payload), self._seq)
+                + payload
+            )
+
+    def flush(self):
+        with self._lock:
+            if self._log is None:
+                return
+            self._log.flush()
+            os.fsync(self._log.fileno())
+
+    def rotate(self):
+        # the records so far go in the next snapshot, returns the last one; if
+        # the previous log is still there its snapshot failed, keep appending
+        with self._lock:
+            if self._log is not None and not os.path.isfile(self._old_log_path):
+                self._log.flush()
+                os.fsync(self._log.fileno())
+                self._log.close()
+                self._log = None
+                os.replace(self._log_path, self._old_log_path)
+            return self._seq
+
+    def write_snapshot(self, state, seq):
+        body = json.dumps(state).encode("utf-8")
+        with open(self._tmp_path, "wb") as file:
+            file.write(
+                self.SNAPSHOT_HEADER.pack(
+                    self.SNAPSHOT_MAGIC, len(body), zlib.crc32(body), seq
+                )
+            )
+            file.write(body)
+            file.flush()
+            os.fsync(file.fileno())
+
+        # readers find the previous snapshot or this one, never a half written one
+        os.replace(self._tmp_path, self._path)
+        if os.path.isfile(self._old_log_path):
+            os.remove(self._old_log_path)
+        return len(body)
+
+    def read_snapshot(self):
+        # (state, last log record in it), None if missing; a damaged one raises,
+        # the log after it would be replayed on an empty twin
+        if not os.path.isfile(self._path):
+            return None
+        if os.path.getsize(self._path) == 0:
+            raise DamagedDumpError(f"Empty snapshot {self._path}.")
+
+        with open(self._path, "rb") as file, mmap.mmap(
+            file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as view:
+            if view[:1] == b"{":
+                # plain json dump of an older version
+                try:
+                    return json.loads(view[:]), 0
+                except ValueError:
+                    raise DamagedDumpError(f"Damaged snapshot {self._path}.")
+
+            size = self.SNAPSHOT_HEADER.size
+            if len(view) < size:
+                raise DamagedDumpError(f"Truncated snapshot {self._path}.")
+
+            magic, length, crc, seq = self.SNAPSHOT_HEADER.unpack_from(view)
+            body = view[size : size + length]
+            if (
+                magic != self.SNAPSHOT_MAGIC
+                or len(body) != length
+                or zlib.crc32(body) != crc
+            ):
+                raise DamagedDumpError(f"Damaged snapshot {self._path}.")
+
+        with self._lock:
+            self._seq = max(self._seq, seq)
+        return json.loads(body), seq
+
+    def read_log(self, after):
+        # records after a seq, up to the first damaged one (the tail torn by a
+        # crash), which is cut so new records are not appended after it; a log
+        # not following on from the seq raises
+        records = []
+        damaged = False
+        for path in (self._old_log_path, self._log_path):
+            if not os.path.isfile(path):
+                continue
+            if damaged:
+                # records after a gap can not be applied
+                os.truncate(path, 0)
+                continue
+
+            with open(path, "rb") as file:
+                data = file.read()
+
+            offset = 0
+            size = self.RECORD_HEADER.size
+            while offset < len(data):
+                if offset + size > len(data):
+                    damaged = True
+                    break
+                length, crc, seq = self.RECORD_HEADER.unpack_from(data, offset)
+                payload = data[offset + size : offset + size + length]
+                if len(payload) != length or zlib.crc32(payload) != crc:
+                    damaged = True
+                    break
+
+                offset += size + length
+                with self._lock:
+                    self._seq = max(self._seq, seq)
+                if seq > after:
+                    if seq != after + len(records) + 1:
+                        raise DamagedDumpError(
+                            f"Dump log jumps to record {seq} after {after + len(records)}."
+                        )
+                    records.append(json.loads(payload))
+
+            if damaged:
+                logger.warning(f"Damaged record in {path} at {offset}, ignoring the rest.")
+                os.truncate(path, offset)
+
+        return records
 
 
 class DigitalTwinState(Enum):
@@ -172,17 +1194,46 @@ class DigitalTwin:
             [VirtualSensor(f"sensor_{i}") for i in range(no_sensors)],
         )
         self._odte = None
-        self._messages = collections.deque(maxlen=messages_deque_length)
-        self._observations = collections.deque(maxlen=observations_deque_length)
+        self._odte_windows = {}
+        self._messages = MessageLog(maxlen=messages_deque_length, retain_payloads=retain_payloads)
+        self._observations = TimeIndexedRing(maxlen=observations_deque_length, keep_sorted=True)
         self._average = 0.0
 
         self._lock = threading.Lock()
-        self._sums = collections.deque(maxlen=messages_deque_length)
+        self._sums = WindowedAggregate(maxlen=messages_deque_length)
+
+        needed_messages = math.ceil(
+            max([odte_window_length_sec, *odte_windows]) * odte_expected_msg_sec
+        )
+        if messages_deque_length < needed_messages:
+            logger.warning(
+                f"Messages deque holds {messages_deque_length} messages, {needed_messages} are needed to cover the ODTE windows. Reliability will be underestimated."
+            )
+
+        self._state_listeners = []
+        self._odte_event = threading.Event()
+
+        # catch up on the messages replayed by the broker after connecting
+        self._connected_at = None
+        self._catching_up = False
+        self._replayed_messages = 0
+        self._duplicate_messages = 0
 
         odte_t = threading.Thread(target=self.odte_thread, daemon=True)
         odte_t.start()
 
-        self.connect_to_mqtt_and_subscribe(mqtt_broker, int(mqtt_port), mqtt_topic)
+        # messages are applied and logged under the ingest lock, snapshots are
+        # taken between two of them
+        self._dump = StateDump(dump_path_file)
+        self._ingest_lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+
+        dump_t = threading.Thread(target=self.dump_thread, daemon=True)
+        dump_t.start()
+
+        # with a dump, connect after restoring it so the replayed messages land on the restored state
+        if not self._dump.exists():
+            self.connect_to_mqtt_and_subscribe(mqtt_broker, int(mqtt_port), mqtt_topic)
 
     @property
     def state(self):
@@ -192,8 +1243,12 @@ class DigitalTwin:
     @state.setter
     def state(self, value):
         with self._lock:
+            previous = self._state
             self._state = value
 
+        if previous != value:
+            self._notify_state_change(previous, value)
+
     @property
     def obj(self):
         with self._lock:
@@ -214,6 +1269,16 @@ class DigitalTwin:
         with self._lock:
             self._odte = value
 
+    @property
+    def odte_windows(self):
+        with self._lock:
+            return dict(self._odte_windows)
+
+    @odte_windows.setter
+    def odte_windows(self, value):
+        with self._lock:
+            self._odte_windows = value
+
     @property
     def messages_deque(self):
         with self._lock:
@@ -222,7 +1287,9 @@ class DigitalTwin:
     @messages_deque.setter
     def messages_deque(self, value):
         with self._lock:
-            self._messages = collections.deque(value, maxlen=messages_deque_length)
+            self._messages = MessageLog(
+                value, maxlen=messages_deque_length, retain_payloads=retain_payloads
+            )
 
     @property
     def observations(self):
@@ -232,8 +1299,8 @@ class DigitalTwin:
     @observations.setter
     def observations(self, value):
         with self._lock:
-            self._observations = collections.deque(
-                value, maxlen=observations_deque_length
+            self._observations = TimeIndexedRing(
+                value, maxlen=observations_deque_length, keep_sorted=True
             )
 
     @property
@@ -254,69 +1321,124 @@ class DigitalTwin:
     @sums.setter
     def sums(self, value):
         with self._lock:
-            self._sums = collections.deque(value, maxlen=messages_deque_length)
+            self._sums = WindowedAggregate(value, maxlen=messages_deque_length)
 
     def restore_state(self):
         global mqtt_broker, mqtt_port, mqtt_topic, physical_twin_name, observations_deque_length, messages_deque_length
 
-        with open(dump_path_file, "r") as file:
-            dump_file_content = file.readlines()
-
-        dump_file_content = "".join(dump_file_content)   
-        dump = json.loads(dump_file_content)
-
-        self.state = DigitalTwinState[dump["state"]]
-        sensors_list = [
-            VirtualSensor(
-                sensor["name"],
-                sensor["sampling_rate"],
-                sensor["measuring_unit"],
-                VirtualSensorState[sensor["state"]],
-                sensor["value"],
-            )
-            for sensor in dump["object"]["sensors"]
-        ]
-
-        self.obj = VirtualRotatingMachine(dump["object"]["name"], sensors_list)
-        self.odte = dump["odte"]
-        self.messages_deque = dump["messages_deque"]
-        self.observations = dump["observations"]
-        self.average = dump["average"]
-        self.sums = dump["sums"]
+        # the snapshot, then the changes logged after it, both read before any
+        # is applied: a partial state is never served as the twin's
+        try:
+            dump, seq = self._dump.read_snapshot() or (None, 0)
+            changes = self._dump.read_log(seq)
+        except DamagedDumpError as e:
+            logger.error(f"State dump not usable, starting fresh instance. {e}")
+            self._dump.clear()
+            self.connect_to_mqtt_and_subscribe(mqtt_broker, int(mqtt_port), mqtt_topic)
+            return False
+
+        if dump is not None:
+            self.state = DigitalTwinState[dump["state"]]
+            self.obj = VirtualRotatingMachine.from_json(dump["object"])
+            self.odte = dump["odte"]
+            self.messages_deque = dump["messages_deque"]
+            self.observations = dump["observations"]
+            self.average = dump["average"]
+            self.sums = dump["sums"]
+            logger.debug(f"Restored state: {dump}")
+
+        for change in changes:
+            self.apply_change(change)
+        if len(changes) > 0:
+            self.average = self._sums.mean
+            logger.info(f"Replayed {len(changes)} changes from the dump log.")
 
         logger.info(f"Average recovered: {self.average}.")
 
-        logger.debug(f"Restored state: {dump}")
-
         # restore connection to the broker after restoring state
         self.connect_to_mqtt_and_subscribe(mqtt_broker, int(mqtt_port), mqtt_topic)
+        return True
 
     def dump_state(self):
         # stop listening to updates so the state doesn t change
         self.disconnect_from_mqtt()
 
-        state = {
-            "state": self.state.name,
-            "object": self.obj.to_json(),
-            "odte": self.odte,
-            "messages_deque": list(self.messages_deque),
-            "observations": list(self.observations),
-            "average": self.average,
-            "sums": list(self._sums),
+        # every change is already in the log, only its tail is left
+        self.flush_dump()
+        logger.info(f"Dump log size: {self._dump.log_size / 1024 / 1024} megabytes.")
+
+    def snapshot_state(self):
+        with self._snapshot_lock:
+            # taken between two messages, the log holds exactly the ones after
+            with self._ingest_lock:
+                state = {
+                    "state": self.state.name,
+                    "object": self.obj.to_json(),
+                    "odte": self.odte,
+                    "messages_deque": list(self.messages_deque),
+                    "observations": self.observations.items(),
+                    "average": self.average,
+                    "sums": list(self._sums),
+                }
+                seq = self._dump.rotate()
+
+            size = self._dump.write_snapshot(state, seq)
+        logger.info(f"State size: {size / 1024 / 1024} megabytes.")
+
+    def dump_thread(self):
+        while True:
+            time.sleep(dump_flush_interval)
+            try:
+                self._dump.flush()
+                if self._dump.log_size > dump_log_max_bytes:
+                    self.snapshot_state()
+            except OSError as e:
+                logger.error(f"Error while writing the state dump. {e}")
+
+    def has_dump(self):
+        return self._dump.exists()
+
+    def flush_dump(self):
+        try:
+            self._dump.flush()
+        except OSError as e:
+            logger.error(f"Error while flushing the dump log. {e}")
+
+    def log_change(self, entry, values, observation, sensors):
+        # compact delta of one message, replayed on top of the snapshot
+        obj = self.obj
+        change = {
+            "entry": entry,
+            "values": values,
+            "observation": observation,
+            "sensors": {name: obj.sensors[name].value for name in sensors},
         }
-
-        logger.info(
-            f"State size: {len(json.dumps(state).encode("utf-8")) / 1024 / 1024} megabytes."
+        try:
+            self._dump.append(change)
+        except OSError as e:
+            logger.error(f"Error while appending to the dump log. {e}")
+
+    def apply_change(self, change):
+        self._messages.extend([change["entry"]])
+        for value in change["values"]:
+            self._sums.append(value)
+        self._observations.append(*change["observation"])
+        self._object.apply_readings(
+            [
+                {"sensor": name, "value": value}
+                for name, value in change["sensors"].items()
+            ]
         )
 
-        with open(dump_path_file, "w") as file:
-            file.writelines(json.dumps(state))
-
     def on_connect(self, client, userdata, flags, reason_code, properties):
         if reason_code == 0:
             logger.info(f"Connected to MQTT Broker at {mqtt_broker}")
 
     def on_message(self, client, userdata, message):
+        with self._ingest_lock:
+            self._ingest_message(message)
+
+    def _ingest_message(self, message):
         global exec_measurements
 
         on_message_exec_start = time.time()
@@ -324,19 +1446,53 @@ class DigitalTwin:
         received_timestamp = time.time()
         start_exec_time = time.time()
 
-        data = json.loads(message.payload)
-        self.messages_deque.append(data)
+        data = codec_for_topic(message.topic).decode(message.payload)
+        if self.messages_deque.is_duplicate(data):
+            with self._lock:
+                self._duplicate_messages += 1
+            logger.debug(f"Duplicate message {data.get("seq")} dropped.")
+            return
 
-        for read in data["readings"]:
-            sensor_to_update = self.obj.sensors[read["sensor"]]
-            sensor_to_update.value = read["value"]
-            self._sums.append(sensor_to_update.value)
+        with self._lock:
+            if self._catching_up and data["timestamp"] < self._connected_at:
+                self._replayed_messages += 1
+            elif self._catching_up:
+                self._catching_up = False
+                logger.info(
+                    f"Caught up {self._replayed_messages} replayed messages in {received_timestamp - self._connected_at} s."
+                )
+
+        entry = self.messages_deque.append(
+            data, received_timestamp, len(message.payload)
+        )
 
-        if len(self._sums) > 0:
-            self.average = sum(self._sums) / len(self._sums)
+        obj = self.obj
+        if "readings" in data:
+            values = [read["value"] for read in data["readings"]]
+            changed = obj.apply_readings(data["readings"])
         else:
-            self.average = 0.0
+            if "sensors" in data and not obj.has_layout(data["layout"]):
+                obj.bind_layout(data["layout"], data["sensors"])
+                logger.info(f"Bound sensor layout {data["layout"]}.")
+
+            values = data["values"]
+            changed = obj.apply_values(data["layout"], values, data.get("indices"))
+            if changed is None:
+                logger.warning(
+                    f"Unknown sensor layout {data["layout"]}, waiting for its announcement."
+                )
+                values = []
+                changed = set()
+
+        for value in values:
+            self._sums.append(value)
+        logger.debug(f"Sensors changed: {len(changed)}")
+
+        self.average = self._sums.mean
         logger.info(f"Current average: {self.average}.")
+        logger.debug(
+            f"Window min: {self._sums.min}\tmax: {self._sums.max}\tvariance: {self._sums.variance}"
+        )
 
         if self.average > average_threshold:
             logger.warning(f"Average over threshold: {self.average}.")
@@ -346,71 +1502,172 @@ class DigitalTwin:
         message_timestamp = data["timestamp"]
 
         # odte timeliness computation
-        self.observations.append(
-            received_timestamp - message_timestamp + execution_timestamp
-        )
+        observation = received_timestamp - message_timestamp + execution_timestamp
+        self.observations.append(observation, message_timestamp)
 
-        for sensor in self.obj.sensors.values():
-            logger.debug(f"{sensor.name}: {sensor.value}")
+        # wake the ODTE engine up for an immediate recompute
+        self._odte_event.set()
+
+        if logger.isEnabledFor(logging.DEBUG):
+            for sensor in obj.sensors.values():
+                logger.debug(f"{sensor.name}: {sensor.value}")
 
         on_message_exec_total = time.time() - on_message_exec_start
         exec_measurements.append(on_message_exec_total)
+        self.log_change(entry, values, [observation, message_timestamp], changed)
+
+    @property
+    def replayed_messages(self):
+        with self._lock:
+            return self._replayed_messages
+
+    @property
+    def duplicate_messages(self):
+        with self._lock:
+            return self._duplicate_messages
 
     def connect_to_mqtt_and_subscribe(self, broker_ip, broker_port, topic):
-        self._MQTT_CLIENT = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        if mqtt_persistent_session:
+            self._MQTT_CLIENT = mqtt.Client(
+                mqtt.CallbackAPIVersion.VERSION2,
+                client_id=mqtt_client_id,
+                protocol=mqtt.MQTTv5,
+            )
+        else:
+            self._MQTT_CLIENT = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
         self._MQTT_CLIENT.on_connect = self.on_connect
         self._MQTT_CLIENT.on_message = self.on_message
+        self._MQTT_CLIENT.on_disconnect = self.on_disconnect
+        self._MQTT_CLIENT.max_inflight_messages_set(mqtt_max_inflight)
 
-        self._MQTT_CLIENT.connect(broker_ip, broker_port)
-        self._MQTT_CLIENT.subscribe(f"{topic}/{self.obj.name}")
+        with self._lock:
+            self._connected_at = time.time()
+            self._catching_up = mqtt_persistent_session
+            self._replayed_messages = 0
+
+        if mqtt_persistent_session:
+            properties = Properties(PacketTypes.CONNECT)
+            properties.SessionExpiryInterval = mqtt_session_expiry
+            self._MQTT_CLIENT.connect(
+                broker_ip, broker_port, clean_start=False, properties=properties
+            )
+        else:
+            self._MQTT_CLIENT.connect(broker_ip, broker_port)
+        # plain topic carries JSON, "<topic>/<machine>/<codec>" the other codecs
+        self._MQTT_CLIENT.subscribe(
+            [
+                (f"{topic}/{self.obj.name}", mqtt_qos),
+                (f"{topic}/{self.obj.name}/+", mqtt_qos),
+            ]
+        )
 
         self.state = DigitalTwinState.BOUND
 
         self._MQTT_CLIENT.loop_start()
 
     def disconnect_from_mqtt(self):
+        # a clean disconnect keeps the session, the broker queues the next messages
+        self._MQTT_CLIENT.disconnect()
         self._MQTT_CLIENT.loop_stop()
         self.state = DigitalTwinState.UNBOUND
 
+    def on_disconnect(self, client, userdata, flags, reason_code, properties):
+        # the next instance took the session over, stop reconnecting to it
+        if reason_code == 142:
+            logger.info("MQTT session taken over by another instance.")
+            client.loop_stop()
+            # a client replaced by this instance, the current one is still bound
+            if client is self._MQTT_CLIENT:
+                self.state = DigitalTwinState.UNBOUND
+
     def compute_timeliness(self, desired_timeliness_sec: float) -> float:
-        obs_list = list(self.observations)
+        observations = self.observations
+        total = len(observations)
 
-        if len(obs_list) == 0:
+        if total == 0:
             return 0.0
 
-        count = 0
-        for obs in obs_list:
-            if obs <= desired_timeliness_sec:
-                count += 1
-
-        percentile = float(count / len(obs_list))
+        percentile = float(observations.count_at_most(desired_timeliness_sec) / total)
 
         return percentile
 
     def compute_reliability(
-        self, window_length_sec: int, expected_msg_sec: int
+        self, window_length_sec: float, expected_msg_sec: float, end_window_time=None
     ) -> float:
-        end_window_time = time.time()
-        start_window_time = time.time() - window_length_sec
-
-        msg_list = list(self.messages_deque)
-        msg_required = msg_list[-window_length_sec * expected_msg_sec :]
-
-        count = 0
-        for msg in msg_required:
-            if (
-                msg["timestamp"] >= start_window_time
-                and msg["timestamp"] <= end_window_time
-            ):
-                count += 1
+        if end_window_time is None:
+            end_window_time = time.time()
+        start_window_time = end_window_time - window_length_sec
 
         expected_msg_tot = window_length_sec * expected_msg_sec
+        if expected_msg_tot <= 0:
+            return 0.0
+
+        count = self.messages_deque.count_between(
+            start_window_time, end_window_time, last=math.ceil(expected_msg_tot)
+        )
 
-        return float(count / expected_msg_tot)
+        return min(float(count / expected_msg_tot), 1.0)
 
     def compute_availability(self) -> float:
         return 1.0
 
+    def compute_odte_window(
+        self,
+        window_length_sec,
+        desired_timeliness_sec,
+        expected_msg_sec,
+        end_window_time=None,
+    ):
+        # ODTE restricted to the observations of a single window
+        if end_window_time is None:
+            end_window_time = time.time()
+        start_window_time = end_window_time - window_length_sec
+
+        total, timely = self.observations.count_at_most_between(
+            start_window_time, end_window_time, desired_timeliness_sec
+        )
+        timeliness = 0.0
+        if total > 0:
+            timeliness = float(timely / total)
+        reliability = self.compute_reliability(
+            window_length_sec, expected_msg_sec, end_window_time
+        )
+
+        return timeliness * reliability * self.compute_availability()
+
+    def compute_odte_windows(
+        self, windows_length_sec, desired_timeliness_sec, expected_msg_sec
+    ):
+        now = time.time()
+        return {
+            window_length_sec: self.compute_odte_window(
+                window_length_sec, desired_timeliness_sec, expected_msg_sec, now
+            )
+            for window_length_sec in windows_length_sec
+        }
+
+    def compute_odte_history(
+        self, window_length_sec, desired_timeliness_sec, expected_msg_sec, windows=6
+    ):
+        # ODTE of consecutive past windows, most recent first
+        now = time.time()
+        history = []
+        for i in range(windows):
+            end_window_time = now - i * window_length_sec
+            history.append(
+                {
+                    "end": end_window_time,
+                    "odte": self.compute_odte_window(
+                        window_length_sec,
+                        desired_timeliness_sec,
+                        expected_msg_sec,
+                        end_window_time,
+                    ),
+                }
+            )
+
+        return history
+
     def compute_odte_phytodig(
         self, window_length_sec, desired_timeliness_sec, expected_msg_sec
     ):
@@ -424,17 +1681,57 @@ class DigitalTwin:
 
         return timeliness * reliability * availability
 
+    def add_state_listener(self, callback):
+        with self._lock:
+            self._state_listeners.append(callback)
+
+    def remove_state_listener(self, callback):
+        with self._lock:
+            self._state_listeners.remove(callback)
+
+    def _notify_state_change(self, previous, current):
+        with self._lock:
+            listeners = list(self._state_listeners)
+
+        for listener in listeners:
+            try:
+                listener(previous, current, self._odte)
+            except Exception as e:
+                logger.error(f"State listener failed. {e}")
+
     def odte_thread(self):
-        global odte_threshold
+        global odte_threshold, odte_window_length_sec, odte_desired_timeliness_sec, odte_expected_msg_sec, odte_windows
         while True:
+            # woken up by on_message, or when the oldest message leaves a window
+            expiries = [
+                expiry
+                for expiry in (
+                    self.messages_deque.next_expiry(window_length_sec)
+                    for window_length_sec in [odte_window_length_sec, *odte_windows]
+                )
+                if expiry is not None
+            ]
+            self._odte_event.wait(min(expiries) if len(expiries) > 0 else None)
+            self._odte_event.clear()
+
             logger.debug(f"Computing odte {time.time()}")
             if (
                 self.state == DigitalTwinState.BOUND
                 or self.state == DigitalTwinState.ENTANGLED
                 or self.state == DigitalTwinState.DISENTANGLED
             ):
-                computed_odte = self.compute_odte_phytodig(10, 0.5, 1)
+                computed_odte = self.compute_odte_phytodig(
+                    odte_window_length_sec,
+                    odte_desired_timeliness_sec,
+                    odte_expected_msg_sec,
+                )
                 self.odte = computed_odte
+                if len(odte_windows) > 0:
+                    self.odte_windows = self.compute_odte_windows(
+                        odte_windows,
+                        odte_desired_timeliness_sec,
+                        odte_expected_msg_sec,
+                    )
                 logger.info(f"ODTE computed: {computed_odte}, state: {self.state}")
                 if (
                     computed_odte < odte_threshold
@@ -446,7 +1743,53 @@ class DigitalTwin:
                     or self.state == DigitalTwinState.BOUND
                 ):
                     self.state = DigitalTwinState.ENTANGLED
-            time.sleep(1)
+
+
+@app.route("/odte/history")
+def odte_history():
+    global digital_twin
+    windows = int(request.args.get("windows", 6))
+    return {
+        "history": digital_twin.compute_odte_history(
+            odte_window_length_sec,
+            odte_desired_timeliness_sec,
+            odte_expected_msg_sec,
+            windows,
+        )
+    }
+
+
+@app.route("/events")
+def state_events():
+    global digital_twin
+    events = queue.Queue()
+
+    def on_state_change(previous, current, odte):
+        events.put(
+            {
+                "previous": previous.name,
+                "state": current.name,
+                "odte": odte,
+                "timestamp": time.time(),
+            }
+        )
+
+    def stream():
+        digital_twin.add_state_listener(on_state_change)
+        try:
+            yield f"data: {json.dumps({"state": digital_twin.state.name, "odte": digital_twin.odte})}\n\n"
+            while True:
+                try:
+                    event = events.get(timeout=15)
+                except queue.Empty:
+                    # keep-alive, also detects closed subscribers
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"data: {json.dumps(event)}\n\n"
+        finally:
+            digital_twin.remove_state_listener(on_state_change)
+
+    return Response(stream(), mimetype="text/event-stream")
 
 
 @app.route("/metrics")
@@ -457,14 +1800,30 @@ def odte_prometheus():
             "[", "{"
         ).replace("]", "}")
     )
+    for window_length_sec, odte in digital_twin.odte_windows.items():
+        prometheus_template += "\n" + (
+            f'odte_window[pt="{digital_twin.obj.name}",window="{window_length_sec:g}"] {str(odte)}'.replace(
+                "[", "{"
+            ).replace("]", "}")
+        )
+    prometheus_template += "\n" + (
+        f'mqtt_replayed_messages[pt="{digital_twin.obj.name}"] {digital_twin.replayed_messages}'.replace(
+            "[", "{"
+        ).replace("]", "}")
+    )
+    prometheus_template += "\n" + (
+        f'mqtt_duplicate_messages[pt="{digital_twin.obj.name}"] {digital_twin.duplicate_messages}'.replace(
+            "[", "{"
+        ).replace("]", "}")
+    )
     return prometheus_template
 
 
 if __name__ == "__main__":
     digital_twin = DigitalTwin()
-    if os.path.isfile(dump_path_file):
-        digital_twin.restore_state()
-        logger.info(f"State restored from file {dump_path_file}.")
+    if digital_twin.has_dump():
+        if digital_twin.restore_state():
+            logger.info(f"State restored from file {dump_path_file}.")
     else:
         logger.info("State dump not found. Starting fresh instance.")
     app.run(host="0.0.0.0", port=8001)
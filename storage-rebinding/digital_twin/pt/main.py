@@ -8,6 +8,16 @@ import os
 import paho.mqtt.client as mqtt
 import logging
 import signal
+import zlib
+import array
+import math
+import struct
+import sys
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 # Global vars
 # logging
@@ -18,6 +28,8 @@ logging.basicConfig(level=logging.INFO)
 mqtt_broker = os.environ.get("MQTT_BROKER")
 mqtt_port = os.environ.get("MQTT_PORT")
 mqtt_topic = os.environ.get("MQTT_TOPIC")
+# QoS 1, the broker queues the messages for the persistent session of the twin
+mqtt_qos = int(os.environ.get("MQTT_QOS", 1))
 mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
 if mqtt_broker is None or mqtt_port is None or mqtt_topic is None:
     logger.error("Required vars for MQTT connection are not correctly configured.")
@@ -36,6 +48,15 @@ mqtt_client.loop_start()
 # Application
 app = Flask(__name__)
 no_sensors = int(os.environ.get("NO_SENSORS", 100))
+# "named" repeats the sensor name in every reading, "positional" sends values in layout order
+payload_format = os.environ.get("PAYLOAD_FORMAT", "named")
+layout_interval = int(os.environ.get("LAYOUT_INTERVAL", 60))
+# "json", "msgpack" or "packed" (packed always uses the positional format)
+payload_codec = os.environ.get("PAYLOAD_CODEC", "json")
+# "full" publishes every sensor, "delta" only the ones that moved past the deadband
+publish_mode = os.environ.get("PUBLISH_MODE", "full")
+delta_deadband = float(os.environ.get("DELTA_DEADBAND", 0.0))
+keyframe_interval = int(os.environ.get("KEYFRAME_INTERVAL", 30))
 
 
 def graceful_shutdown(signum, frame):
@@ -51,6 +72,140 @@ signal.signal(signal.SIGINT, graceful_shutdown)
 signal.signal(signal.SIGTERM, graceful_shutdown)
 
 
+def layout_id(sensor_names):
+    # stable identifier of a sensor ordering, shared by the physical and digital twin
+    return zlib.crc32("\n".join(sensor_names).encode("utf-8"))
+
+
+class JsonCodec:
+    name = "json"
+    content_type = "application/json"
+
+    def encode(self, message):
+        return json.dumps(message).encode("utf-8")
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    content_type = "application/msgpack"
+
+    def encode(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+class PackedCodec:
+    # little-endian header: version, flags, reserved, layout id, seq, timestamp, no. of values
+    HEADER = struct.Struct("<BBHIIdI")
+    # version 1 frames had no sequence number
+    HEADER_V1 = struct.Struct("<BBHIdI")
+    NAMES_LENGTH = struct.Struct("<I")
+    VERSION = 2
+    FLAG_LAYOUT = 0x01
+    FLAG_DELTA = 0x02
+
+    name = "packed"
+    content_type = "application/vnd.dt.packed"
+
+    def encode(self, message):
+        if "values" not in message:
+            raise ValueError("Packed codec only encodes positional messages.")
+
+        values = message["values"]
+        flags = self.FLAG_LAYOUT if "sensors" in message else 0
+        if message.get("delta", False):
+            flags |= self.FLAG_DELTA
+        payload = bytearray(
+            self.HEADER.pack(
+                self.VERSION,
+                flags,
+                0,
+                message["layout"],
+                message.get("seq", 0),
+                message["timestamp"],
+                len(values),
+            )
+        )
+
+        packed_values = array.array(
+            "d", [math.nan if value is None else value for value in values]
+        )
+        if sys.byteorder == "big":
+            packed_values.byteswap()
+        payload += packed_values.tobytes()
+
+        if flags & self.FLAG_DELTA:
+            packed_indices = array.array("I", message["indices"])
+            if sys.byteorder == "big":
+                packed_indices.byteswap()
+            payload += packed_indices.tobytes()
+
+        if flags & self.FLAG_LAYOUT:
+            names = "\n".join(message["sensors"]).encode("utf-8")
+            payload += self.NAMES_LENGTH.pack(len(names)) + names
+
+        return bytes(payload)
+
+    def decode(self, payload):
+        version = payload[0]
+        if version == self.VERSION:
+            _, flags, _, layout, seq, timestamp, count = self.HEADER.unpack_from(
+                payload
+            )
+            offset = self.HEADER.size
+        elif version == 1:
+            _, flags, _, layout, timestamp, count = self.HEADER_V1.unpack_from(payload)
+            seq = None
+            offset = self.HEADER_V1.size
+        else:
+            raise ValueError(f"Unsupported packed payload version {version}.")
+
+        values = array.array("d")
+        values.frombytes(payload[offset : offset + 8 * count])
+        if sys.byteorder == "big":
+            values.byteswap()
+        offset += 8 * count
+
+        message = {
+            "layout": layout,
+            "values": [None if value != value else value for value in values.tolist()],
+            "timestamp": timestamp,
+        }
+        if seq is not None:
+            message["seq"] = seq
+
+        if flags & self.FLAG_DELTA:
+            indices = array.array("I")
+            indices.frombytes(payload[offset : offset + indices.itemsize * count])
+            if sys.byteorder == "big":
+                indices.byteswap()
+            offset += indices.itemsize * count
+            message["indices"] = indices.tolist()
+            message["delta"] = True
+
+        if flags & self.FLAG_LAYOUT:
+            (names_length,) = self.NAMES_LENGTH.unpack_from(payload, offset)
+            offset += self.NAMES_LENGTH.size
+            names = bytes(payload[offset : offset + names_length]).decode("utf-8")
+            message["sensors"] = names.split("\n")
+
+        return message
+
+
+codecs = {"json": JsonCodec(), "packed": PackedCodec()}
+if msgpack is not None:
+    codecs["msgpack"] = MsgpackCodec()
+
+if payload_codec not in codecs:
+    logger.error(f"PAYLOAD_CODEC {payload_codec} is not available.")
+    exit(1)
+
+
 class SensorState(Enum):
     WORKING = 0
     STOPPED = 1
@@ -160,6 +315,10 @@ class RotatingMachine:
     def __init__(self, name="rotating_machine", sensors_list=[]):
         self._name = name
         self._sensors = {sensor.name: sensor for sensor in sensors_list}
+        self._layout = list(self._sensors)
+        self._layout_id = layout_id(self._layout)
+        self._messages_sent = 0
+        self._last_sent = [None] * len(self._layout)
 
         self._lock = threading.Lock()
         self._running_simulation = False
@@ -183,6 +342,85 @@ class RotatingMachine:
         with self._lock:
             self._running_simulation = value
 
+    @property
+    def layout(self):
+        return self._layout
+
+    @property
+    def layout_id(self):
+        return self._layout_id
+
+    def build_message(self):
+        global payload_format, payload_codec, layout_interval, publish_mode, keyframe_interval, delta_deadband
+
+        sensors = list(self.sensors.values())
+        values = [sensor.value for sensor in sensors]
+
+        keyframe = (
+            publish_mode != "delta" or self._messages_sent % keyframe_interval == 0
+        )
+        if keyframe:
+            indices = range(len(sensors))
+        else:
+            indices = [
+                i
+                for i, value in enumerate(values)
+                if value is not None
+                and (
+                    self._last_sent[i] is None
+                    or abs(value - self._last_sent[i]) > delta_deadband
+                )
+            ]
+        if publish_mode == "delta":
+            for i in indices:
+                if values[i] is not None:
+                    self._last_sent[i] = values[i]
+
+        if payload_format == "positional" or payload_codec == "packed":
+            if keyframe:
+                message = {"layout": self._layout_id, "values": values}
+            else:
+                message = {
+                    "layout": self._layout_id,
+                    "indices": indices,
+                    "values": [values[i] for i in indices],
+                }
+            # announce the ordering periodically so late subscribers can bind it
+            if self._messages_sent % layout_interval == 0:
+                message["sensors"] = self._layout
+        else:
+            message = {
+                "readings": [
+                    {
+                        "sensor": sensors[i].name,
+                        "value": values[i],
+                        "timestamp": time.time(),
+                    }
+                    for i in indices
+                    # delta mode does not publish sensors that never produced a reading
+                    if publish_mode != "delta" or values[i] is not None
+                ]
+            }
+
+        # deltas are sent every tick, even when empty, so the twin's reliability
+        # accounting counts keyframes and deltas alike
+        if not keyframe:
+            message["delta"] = True
+        message["seq"] = self._messages_sent
+        self._messages_sent += 1
+        message["timestamp"] = time.time()
+        return message
+
+    def message_values(self, message):
+        if "readings" in message:
+            return [(read["sensor"], read["value"]) for read in message["readings"]]
+        if "indices" in message:
+            return [
+                (self._layout[i], value)
+                for i, value in zip(message["indices"], message["values"])
+            ]
+        return list(zip(self._layout, message["values"]))
+
     def start_simulation(self):
         for sensor in self.sensors.values():
             sensor.run_sensor_simulation()
@@ -209,23 +447,24 @@ class RotatingMachine:
     def publish_to_mqtt_thread(self):
         global mqtt_client
         while self.running_simulation:
-            readings = []
-            for sensor in self.sensors.values():
-                read = {
-                    "sensor": sensor.name,
-                    "value": sensor.value,
-                    "timestamp": time.time(),
-                }
-                readings.append(read)
+            message = self.build_message()
+            codec = codecs[payload_codec]
+            payload = codec.encode(message)
+
+            topic = f"{mqtt_topic}/{self.name}"
+            if codec.name != "json":
+                topic = f"{topic}/{codec.name}"
 
             mqtt_client.publish(
-                f"{mqtt_topic}/{self.name}",
-                json.dumps({"readings": readings, "timestamp": time.time()}),
+                topic,
+                payload,
+                qos=mqtt_qos,
             )
-            logger.info(f"Message size: {len(json.dumps(readings))}")
+            logger.info(f"Message size: {len(payload)}")
             logger.debug(f"Published message:")
-            for read in readings:
-                logger.debug(f"{read["sensor"]}: {read["value"]}")
+            if logger.isEnabledFor(logging.DEBUG):
+                for name, value in self.message_values(message):
+                    logger.debug(f"{name}: {value}")
             time.sleep(1)
 
     def to_json(self):
@@ -245,6 +484,13 @@ def get_sensors():
     return jsonify(sensor_data)
 
 
+@app.route("/layout", methods=["GET"])
+def get_layout():
+    return jsonify(
+        {"layout": rotating_machine.layout_id, "sensors": rotating_machine.layout}
+    )
+
+
 @app.route("/machine", methods=["GET"])
 def get_machine():
     return jsonify(rotating_machine.to_json())
@@ -1,8 +1,19 @@
-import kopf, requests, json, random, datetime, os
+import kopf, requests, json, random, datetime, os, time
+import asyncio, functools, concurrent.futures, aiohttp
 from kubernetes import client
-from kubernetes.utils import create_from_dict
-from k8s_utils import delete_from_dict
+from k8s_utils import (
+    AsyncApi,
+    shared_api_client,
+    FailToCreateError,
+    FailToDeleteError,
+    create_from_dicts,
+    delete_from_dicts,
+    wait_for_pods,
+    wait_for_pods_ready,
+    wait_for_pods_deleted,
+)
 from graph_utils import generate_chart
+from placement_utils import default_engine
 
 cluster_ip = os.environ.get("CLUSTER_IP")
 
@@ -10,10 +21,58 @@ if not cluster_ip:
     print("CLUSTER_IP env var not present. Exiting.")
     exit(1)
 
+
+# migrations running at the same time, across all the CPAs
+max_concurrent_migrations = int(os.environ.get("MAX_CONCURRENT_MIGRATIONS", 10))
+migration_semaphore = asyncio.Semaphore(max_concurrent_migrations)
+# a CPA is migrated by one handler at a time
+migration_locks = {}
+# autonomous migrations, ODTE of the twins read from Prometheus if set, else from /metrics
+auto_migration_interval = float(os.environ.get("AUTO_MIGRATION_INTERVAL", 30))
+prometheus_url = os.environ.get("PROMETHEUS_URL")
+# per CPA: violations of the requirement, end of the last migration
+auto_migration_state = {}
+# scores the target zones of the migrations, refreshed in the background
+placement_engine = default_engine(
+    refresh_interval=float(os.environ.get("PLACEMENT_REFRESH_INTERVAL", 30))
+)
+# create the twin objects with server-side apply instead of create
+server_side_apply = os.environ.get("SERVER_SIDE_APPLY", "false").lower() == "true"
+http_session = None
+
+
+@kopf.on.startup()
+async def startup_fn(logger, **kwargs):
+    global http_session
+    # blocking Kubernetes calls of the migrations run in the default executor
+    asyncio.get_running_loop().set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_migrations * 2)
+    )
+    placement_engine.start(logger)
+    http_session = aiohttp.ClientSession()
+
+
+@kopf.on.cleanup()
+async def cleanup_fn(**kwargs):
+    placement_engine.stop()
+    await http_session.close()
+
+
+def limit_concurrency(handler):
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        key = f"{kwargs.get('namespace')}/{kwargs.get('name')}"
+        lock = migration_locks.setdefault(key, asyncio.Lock())
+        async with lock, migration_semaphore:
+            return await handler(*args, **kwargs)
+
+    return wrapper
+
+
 @kopf.on.create("cyberphysicalapplications")
-def create_fn(spec, meta, namespace, name, logger, **kwargs):
-    k8s_client = client.ApiClient()
-    k8s_custom_object = client.CustomObjectsApi()
+async def create_fn(spec, meta, namespace, name, logger, **kwargs):
+    k8s_client = shared_api_client()
+    k8s_custom_object = AsyncApi(client.CustomObjectsApi())
 
     deployments = spec.get("deployments")
     preferred_affinity = spec.get("requirements").get("preferredAffinity")
@@ -40,6 +99,9 @@ def create_fn(spec, meta, namespace, name, logger, **kwargs):
             config["spec"]["template"]["spec"].update(
                 {"nodeSelector": {"zone": f"{deployment_affinity}"}}
             )
+            set_container_env(
+                config, odte_env(spec.get("requirements")) + twin_env(namespace, name)
+            )
             deployment_namespace = config.get("metadata").get("namespace")
             deployment_app_name = config.get("metadata").get("labels").get("app")
             deployment_prometheus_url = (
@@ -52,10 +114,13 @@ def create_fn(spec, meta, namespace, name, logger, **kwargs):
 
         kopf.label(config, {"related-to": f"{name}"})
         kopf.adopt(config)
-        try:
-            create_from_dict(k8s_client, config)
-        except Exception as e:
-            logger.exception("Exception in object creation.")
+
+    try:
+        await create_from_dicts(
+            k8s_client, deployment_configs, server_side_apply=server_side_apply
+        )
+    except FailToCreateError:
+        logger.exception("Exception in object creation.")
 
     annotations_patch = {"metadata": {"annotations": dict(meta.annotations)}}
     annotations_patch["metadata"]["annotations"][
@@ -74,7 +139,7 @@ def create_fn(spec, meta, namespace, name, logger, **kwargs):
     group = "test.dev"
     version = "v1"
     plural = "cyberphysicalapplications"
-    resp = k8s_custom_object.patch_namespaced_custom_object(
+    resp = await k8s_custom_object.patch_namespaced_custom_object(
         group, version, namespace, plural, name, body=annotations_patch
     )
 
@@ -100,7 +165,98 @@ def get_prometheus_odte(prometheus_url, twin_of, logger):
     return odte
 
 
+def odte_env(requirements):
+    # ODTE parameters of the twin, taken from spec.requirements
+    env = []
+    if requirements is None:
+        return env
+
+    if requirements.get("odte") is not None:
+        env.append({"name": "ODTE_THRESHOLD", "value": str(requirements.get("odte"))})
+
+    parameters = requirements.get("odteParameters") or {}
+    parameters_env = {
+        "windowLength": "ODTE_WINDOW_LENGTH",
+        "desiredTimeliness": "ODTE_DESIRED_TIMELINESS",
+        "expectedMsgRate": "ODTE_EXPECTED_MSG_RATE",
+    }
+    for field, env_name in parameters_env.items():
+        if parameters.get(field) is not None:
+            env.append({"name": env_name, "value": str(parameters.get(field))})
+
+    if parameters.get("windows"):
+        env.append(
+            {
+                "name": "ODTE_WINDOWS",
+                "value": ",".join(str(window) for window in parameters.get("windows")),
+            }
+        )
+
+    return env
+
+
+def twin_env(namespace, name):
+    # identity of the twin, shared by its instances and distinct across the CPAs
+    return [{"name": "MQTT_CLIENT_ID", "value": f"dt-{namespace}-{name}"}]
+
+
+def set_container_env(config, env):
+    container = config["spec"]["template"]["spec"]["containers"][0]
+    names = [var.get("name") for var in env]
+    container["env"] = [
+        var for var in container.get("env", []) if var.get("name") not in names
+    ] + env
+
+
+def auto_migration_entry(namespace, name):
+    return auto_migration_state.setdefault(
+        f"{namespace}/{name}",
+        {"violating": False, "violations": 0, "last_migration": None},
+    )
+
+
+def deployment_service_url(deployment):
+    for config in deployment.get("configs"):
+        if config.get("kind") == "Service":
+            metadata = config.get("metadata")
+            port = config.get("spec").get("ports")[0].get("port")
+            return f"http://{metadata.get('name')}.{metadata.get('namespace', 'default')}.svc.cluster.local:{port}"
+    return None
+
+
+def get_twin_odte(service_url, logger):
+    # odte gauge from the /metrics route of the twin
+    try:
+        resp = requests.get(f"{service_url}/metrics", timeout=5)
+    except requests.RequestException:
+        logger.info("Twin not available.")
+        raise Exception
+
+    for line in resp.text.splitlines():
+        if line.startswith("odte{"):
+            return float(line.rsplit(" ", 1)[1])
+
+    logger.info("ODTE not available.")
+    raise Exception
+
+
+def measure_odte(spec, deployment, logger):
+    if prometheus_url:
+        return get_prometheus_odte(prometheus_url, spec.get("twinOf")[0], logger)
+
+    service_url = deployment_service_url(deployment)
+    if service_url is None:
+        logger.info("No service to scrape the ODTE from.")
+        raise Exception
+    return get_twin_odte(service_url, logger)
+
+
 def choose_next_deployment(deployments, current_deployment_affinity):
+    # best scored zone of the placement engine, random before its first refresh
+    next_deployment = placement_engine.choose(deployments, current_deployment_affinity)
+    if next_deployment is not None:
+        return next_deployment
+
     next_depl_index = random.randint(0, len(deployments) - 1)
     next_depl_affinity = deployments[next_depl_index].get("affinity")
 
@@ -111,44 +267,42 @@ def choose_next_deployment(deployments, current_deployment_affinity):
     return deployments[next_depl_index]
 
 
-def ensure_pod_termination(k8s_core_v1, app_name, namespace, logger):
-    terminated = False
-    label_selector = f"app={app_name}"
-    while not terminated:
-        try:
-            resp = k8s_core_v1.list_namespaced_pod(
-                namespace, label_selector=label_selector
-            )
-            if len(resp.items) == 0:
-                terminated = True
-        except:
-            logger.info("Cannot list pods.")
-
+async def ensure_pod_termination(k8s_core_v1, app_name, namespace, logger, timeout=300):
+    """Wait until all pods of the deployment are deleted, False on timeout."""
 
-def ensure_pods_ready(k8s_core_v1, app_name, namespace, logger):
     label_selector = f"app={app_name}"
     try:
-        resp = k8s_core_v1.list_namespaced_pod(namespace, label_selector=label_selector)
-    except:
-        logger.error("Cannot list pods.")
-        return
-
-    pods = resp.items
+        await asyncio.to_thread(
+            wait_for_pods_deleted,
+            k8s_core_v1.api,
+            namespace,
+            label_selector,
+            timeout=timeout,
+            logger=logger,
+        )
+    except TimeoutError:
+        logger.error(f"Pods of {app_name} still present after {timeout}s.")
+        return False
+    return True
 
-    for pod in pods:
-        pod_ready = False
-        pod_name = pod.metadata.name
 
-        while not pod_ready:
-            try:
-                pod_status = k8s_core_v1.read_namespaced_pod_status(pod_name, namespace)
-            except:
-                logger.error("Cannot read pod status.")
+async def ensure_pods_ready(k8s_core_v1, app_name, namespace, logger, timeout=300):
+    """Wait until all pods of the deployment are ready, False on timeout."""
 
-            conditions = pod_status.status.conditions
-            for condition in conditions:
-                if condition.type == "Ready" and condition.status == "True":
-                    pod_ready = True
+    label_selector = f"app={app_name}"
+    try:
+        await asyncio.to_thread(
+            wait_for_pods_ready,
+            k8s_core_v1.api,
+            namespace,
+            label_selector,
+            timeout=timeout,
+            logger=logger,
+        )
+    except TimeoutError:
+        logger.error(f"Pods of {app_name} not ready after {timeout}s.")
+        return False
+    return True
 
 
 @kopf.on.update("cyberphysicalapplications")
@@ -167,15 +321,16 @@ def update_fn(name, spec, namespace, **kwargs):
 
 
 @kopf.on.field("cyberphysicalapplications", field="spec.migrate")
-def migrate_fn(spec, meta, name, old, new, logger, namespace, **_):
+@limit_concurrency
+async def migrate_fn(spec, meta, name, old, new, logger, namespace, **_):
 
     # guard condition for creation
     if old is None:
         return
 
-    k8s_client = client.ApiClient()
-    k8s_core_v1 = client.CoreV1Api()
-    k8s_custom_object = client.CustomObjectsApi()
+    k8s_client = shared_api_client()
+    k8s_core_v1 = AsyncApi(client.CoreV1Api())
+    k8s_custom_object = AsyncApi(client.CustomObjectsApi())
 
     # trigger a migration
     if old == False and new == True:
@@ -199,7 +354,7 @@ def migrate_fn(spec, meta, name, old, new, logger, namespace, **_):
 
         # find rsync source
         label_selector = f"related-to={name}"
-        resp = k8s_core_v1.list_namespaced_service(
+        resp = await k8s_core_v1.list_namespaced_service(
             current_deployment_namespace, label_selector=label_selector
         )
         current_deployment_service_name = resp.items[0].metadata.name
@@ -209,12 +364,12 @@ def migrate_fn(spec, meta, name, old, new, logger, namespace, **_):
         operation_start_time = datetime.datetime.now()
 
         label_selector = f"related-to={name}"
-        resp = k8s_core_v1.list_namespaced_service(current_deployment_namespace, label_selector=label_selector)
+        resp = await k8s_core_v1.list_namespaced_service(current_deployment_namespace, label_selector=label_selector)
         current_deployment_service_port = resp.items[0].spec.ports[0].node_port
         endpoint = "/dump"
         url = f"http://{cluster_ip}:{current_deployment_service_port}{endpoint}"
-        resp = requests.post(url)
-        print(resp.text)
+        async with http_session.post(url) as resp:
+            print(await resp.text())
 
         operation_end_time = datetime.datetime.now()
         timestamps.append([operation_name, operation_start_time, operation_end_time])
@@ -230,6 +385,10 @@ def migrate_fn(spec, meta, name, old, new, logger, namespace, **_):
                 config["spec"]["template"]["spec"].update(
                     {"nodeSelector": {"zone": f"{next_deployment_affinity}"}}
                 )
+                set_container_env(
+                    config,
+                    odte_env(spec.get("requirements")) + twin_env(namespace, name),
+                )
                 next_deployment_namespace = config.get("metadata").get("namespace")
                 next_deployment_app_name = (
                     config.get("metadata").get("labels").get("app")
@@ -257,7 +416,7 @@ def migrate_fn(spec, meta, name, old, new, logger, namespace, **_):
                 )
                 init_container["env"] = [
                     {"name": "RSYNC_SOURCE", "value": current_deployment_service_name},
-                    {"name": "RSYNC_SOURCE_PATH", "value": "dt_data/dump.json"},
+                    {"name": "RSYNC_SOURCE_PATH", "value": "dt_data/dump.json*"},
                     {"name": "RSYNC_DEST_PATH", "value": "/var/tmp/dt_data"},
                 ]
 
@@ -267,16 +426,31 @@ def migrate_fn(spec, meta, name, old, new, logger, namespace, **_):
 
             kopf.adopt(config)
             kopf.label(config, {"related-to": f"{name}"})
-            try:
-                create_from_dict(k8s_client, config)
-                pass
-            except:
-                logger.exception("Exception creating new object.")
+
+        try:
+            await create_from_dicts(
+                k8s_client, next_deployment_configs, server_side_apply=server_side_apply
+            )
+        except FailToCreateError:
+            logger.exception("Exception creating new objects.")
 
         # wait for it to start correctly
-        ensure_pods_ready(
+        if not await ensure_pods_ready(
             k8s_core_v1, next_deployment_app_name, next_deployment_namespace, logger
-        )
+        ):
+            # the source stopped ingesting for the dump, hand the twin back to it
+            url = f"http://{cluster_ip}:{current_deployment_service_port}/resume"
+            try:
+                async with http_session.post(url) as resp:
+                    print(await resp.text())
+            except aiohttp.ClientError:
+                logger.exception("Exception resuming the source instance.")
+            try:
+                await delete_from_dicts(k8s_client, next_deployment_configs)
+            except FailToDeleteError:
+                logger.exception("Exception deleting the target objects.")
+            logger.error("Migration stopped, the target instance is not ready.")
+            return
         print("Deployment's pods started.")
         
         operation_end_time = datetime.datetime.now()
@@ -288,24 +462,27 @@ def migrate_fn(spec, meta, name, old, new, logger, namespace, **_):
         # wait rsync, check if init pods are terminated
         init_pod_name = "rsync-init"
         label_selector = f"app={next_deployment_app_name}"
-        terminated = False
-        resp = k8s_core_v1.list_namespaced_pod(namespace, label_selector=label_selector)
-        while len(resp.items) == 0:
-            resp = k8s_core_v1.list_namespaced_pod(
-                namespace, label_selector=label_selector
-            )
-
-        while not terminated:
-            resp = k8s_core_v1.list_namespaced_pod(
-                namespace, label_selector=label_selector
-            )
-            init_container_statuses = resp.items[0].status.init_container_statuses
 
-            if not init_container_statuses is None:
-                for init_container_status in init_container_statuses:
-                    if init_container_status.name == init_pod_name:
-                        if not init_container_statuses[0].state.terminated is None:
-                            terminated = True
+        def rsync_terminated(pods):
+            for pod in pods:
+                if pod.status is None or pod.status.init_container_statuses is None:
+                    continue
+                for init_container_status in pod.status.init_container_statuses:
+                    if (
+                        init_container_status.name == init_pod_name
+                        and init_container_status.state.terminated is not None
+                    ):
+                        return True
+            return False
+
+        await asyncio.to_thread(
+            wait_for_pods,
+            k8s_core_v1.api,
+            namespace,
+            label_selector,
+            rsync_terminated,
+            logger=logger,
+        )
 
         operation_end_time = datetime.datetime.now()
         timestamps.append([operation_name, operation_start_time, operation_end_time])
@@ -316,10 +493,12 @@ def migrate_fn(spec, meta, name, old, new, logger, namespace, **_):
         # delete old instance
         for depl in deployments:
             if depl.get("affinity") == current_deployment_affinity:
-                for config in depl.get("configs"):
-                    delete_from_dict(k8s_client, config)
+                try:
+                    await delete_from_dicts(k8s_client, depl.get("configs"))
+                except FailToDeleteError:
+                    logger.exception("Exception deleting old objects.")
 
-        ensure_pod_termination(k8s_core_v1, current_deployment_app_name, namespace, logger)
+        await ensure_pod_termination(k8s_core_v1, current_deployment_app_name, namespace, logger)
         
         operation_end_time = datetime.datetime.now()
         timestamps.append([operation_name, operation_start_time, operation_end_time])
@@ -327,9 +506,77 @@ def migrate_fn(spec, meta, name, old, new, logger, namespace, **_):
         group = "test.dev"
         version = "v1"
         plural = "cyberphysicalapplications"
-        resp = k8s_custom_object.patch_namespaced_custom_object(
+        resp = await k8s_custom_object.patch_namespaced_custom_object(
             group, version, namespace, plural, name, body=annotations_patch
         )
 
+        auto_migration_entry(meta.get("namespace"), name)[
+            "last_migration"
+        ] = time.monotonic()
         generate_chart(timestamps)
         return
+
+
+@kopf.timer(
+    "cyberphysicalapplications",
+    interval=auto_migration_interval,
+    when=lambda spec, **_: (spec.get("autoMigration") or {}).get("enabled", False),
+)
+async def auto_migrate_fn(spec, name, logger, meta, namespace, **kwargs):
+    parameters = spec.get("autoMigration")
+    threshold = (spec.get("requirements") or {}).get("odte")
+    if threshold is None:
+        return
+
+    state = auto_migration_entry(namespace, name)
+    deployments = spec.get("deployments")
+
+    current_deployment_affinity = (meta.get("annotations") or {}).get(
+        "child-deployment-affinity"
+    )
+    current_deployment = None
+    for deployment in deployments:
+        if deployment.get("affinity") == current_deployment_affinity:
+            current_deployment = deployment
+    if current_deployment is None:
+        return
+
+    try:
+        odte = await asyncio.to_thread(measure_odte, spec, current_deployment, logger)
+    except Exception:
+        return
+
+    # violating below the requirement, back to normal only above requirement + hysteresis
+    if odte < threshold:
+        state["violating"] = True
+    elif odte >= threshold + parameters.get("hysteresis", 0.05):
+        state["violating"] = False
+    state["violations"] = state["violations"] + 1 if state["violating"] else 0
+
+    if state["violations"] < parameters.get("violations", 3):
+        return
+
+    last_migration = state["last_migration"]
+    if (
+        last_migration is not None
+        and time.monotonic() - last_migration < parameters.get("cooldown", 300)
+    ):
+        logger.info(f"ODTE {odte} violates the requirement {threshold}, migration in cooldown.")
+        return
+
+    lock = migration_locks.get(f"{namespace}/{name}")
+    if lock is not None and lock.locked():
+        return
+
+    logger.info(f"ODTE {odte} violates the requirement {threshold}, migrating.")
+    state["violating"] = False
+    state["violations"] = 0
+    await migrate_fn(
+        spec=spec,
+        name=name,
+        old=False,
+        new=True,
+        logger=logger,
+        meta=meta,
+        namespace=namespace,
+    )